@@ -1,9 +1,261 @@
+import base64
+import math
 import os
 import sys
+from datetime import datetime, timezone
+from functools import wraps
 from flask import Flask, request, jsonify, abort, render_template
+from flask import Response, json, stream_with_context
 from flask_cors import CORS
-from models import setup_db, Clothes, User, Reserve
-from auth import requires_auth, AuthError
+from werkzeug.exceptions import RequestEntityTooLarge
+from models import setup_db, read_only, mark_writes
+from models import start_unit_of_work, finish_unit_of_work, end_unit_of_work
+from models import Clothes, User, Reserve
+from auth import requires_auth, get_access_user, AuthError
+from cache import cached, table_version, write_marks
+from compression import compress_response
+from metrics import registry, start_request, finish_request, query_budget
+from serializers import dumps, json_response
+from serializers import clothes_serializer, user_serializer
+
+# page size of GET /clothes when only a cursor is given
+DEFAULT_PAGE_SIZE = 50
+# the largest page GET /clothes will return
+MAX_PAGE_SIZE = 100
+# the most clothes GET /clothes returns without paging arguments; larger
+# results are cut into pages of this size
+MAX_UNPAGED_SIZE = 1000
+# rows fetched per round trip while streaming a collection
+STREAM_BATCH_SIZE = 500
+# the largest number of clothes POST /clothes/bulk will register at once
+MAX_BULK_SIZE = 10000
+# the largest body in bytes POST /clothes/bulk will read, 10000 clothes
+# take less than 1MB
+MAX_BULK_CONTENT_LENGTH = 4 * 1024 * 1024
+
+# Query budgets
+# SQL statements a handler may issue, declared with @query_budget. They
+# count the access user which authentication loads on a cache miss, but
+# not the table versions counted when the request commits.
+# a page of users
+LIST_USERS_BUDGET = 2
+# a page of clothes with their total count
+LIST_CLOTHES_BUDGET = 3
+# the reserved clothes of a user, after loading the user
+USER_RESERVATIONS_BUDGET = 3
+# the reservations of clothes, after loading the clothes
+CLOTHES_RESERVATIONS_BUDGET = 4
+# inserting one row
+CREATE_BUDGET = 3
+# loading one row and updating it
+UPDATE_BUDGET = 4
+# loading one row and deleting it with the reservations it cascades to
+DELETE_BUDGET = 5
+# claiming clothes and inserting their reservations
+RESERVE_BUDGET = 6
+# deleting reservations and releasing their clothes
+CANCEL_BUDGET = 7
+
+
+def encode_cursor(last_id):
+    """Wrap the id of the last item on a page into an opaque cursor."""
+    data = json.dumps({'id': last_id}).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns: id of the last item on the previous page
+
+    Note: ValueError will be raised if the cursor is malformed.
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(cursor + padding))
+        last_id = data['id']
+    except Exception:
+        raise ValueError('malformed cursor')
+    # bool is a subclass of int, but true is no id
+    if not isinstance(last_id, int) or isinstance(last_id, bool):
+        raise ValueError('malformed cursor')
+    return last_id
+
+
+def get_page_args(args):
+    """Read keyset pagination arguments from the query string.
+
+    Returns: tuple of page size and id after which the page starts
+
+    Note: ValueError will be raised if limit or cursor is malformed.
+    """
+    limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError('limit out of range')
+    cursor = args.get('cursor')
+    last_id = decode_cursor(cursor) if cursor else 0
+    return limit, last_id
+
+
+def filter_clothes(query, args):
+    """Narrow a clothes query by the filters given in the query string.
+    Filters: type, min_size, max_size, status ('reserved' or 'available')
+    and registered_since (ISO 8601 date or datetime, UTC if naive).
+
+    Returns: filtered query
+
+    Note: ValueError will be raised if a filter value is malformed.
+    """
+    if 'type' in args:
+        query = query.filter(Clothes.type == args['type'])
+    if 'min_size' in args:
+        query = query.filter(Clothes.size >= float(args['min_size']))
+    if 'max_size' in args:
+        query = query.filter(Clothes.size <= float(args['max_size']))
+    if 'status' in args:
+        if args['status'] == 'reserved':
+            query = query.filter(Clothes.status == 'reserved')
+        elif args['status'] == 'available':
+            query = query.filter(Clothes.available())
+        else:
+            raise ValueError('unknown status')
+    if 'registered_since' in args:
+        since = datetime.fromisoformat(args['registered_since'])
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        query = query.filter(Clothes.registered_time >= since)
+    return query
+
+
+def stream_collection(key, query, serializer, batch_size=STREAM_BATCH_SIZE):
+    """Stream all rows of a query as a json array without building it
+    in memory. Rows of the serializer's columns are read through a
+    server-side cursor and written out batch by batch, from the read
+    replica if one is configured.
+
+    Returns: streamed response of json object with following attributes
+    {
+        'success': True,
+        key: array of each formatted row,
+        'total': num of rows
+    }
+    """
+    def generate():
+        yield ('{"success":true,"%s":[' % key).encode('utf-8')
+        total = 0
+        chunk = []
+        # the handler has returned, so route the reads here once again
+        with read_only():
+            for row in serializer.project(query).yield_per(batch_size):
+                chunk.append(row)
+                if len(chunk) == batch_size:
+                    yield write_chunk(chunk, total)
+                    total += len(chunk)
+                    chunk = []
+        if chunk:
+            yield write_chunk(chunk, total)
+            total += len(chunk)
+        yield b'],"total":%d}\n' % total
+
+    def write_chunk(chunk, total):
+        # drop the brackets of the encoded array to join it to the stream
+        data = dumps(serializer.format_all(chunk))[1:-1]
+        return b',' + data if total else data
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/json'
+        )
+
+
+def read_bulk_rows(req, max_rows, max_length):
+    """Read the rows of a bulk request, either a json array or
+    newline delimited json ('application/x-ndjson'). Newline delimited
+    json is read line by line, and reading stops as soon as there are
+    more than max_rows rows.
+
+    Returns: list of parsed rows, None for rows which are not valid json
+
+    Note: ValueError will be raised if the body is not a json array or
+          has more than max_rows rows, and RequestEntityTooLarge if it
+          is longer than max_length bytes.
+    """
+    if req.content_length is not None and req.content_length > max_length:
+        raise RequestEntityTooLarge()
+
+    if req.mimetype == 'application/x-ndjson':
+        rows = []
+        remaining = max_length
+        while True:
+            # a line is never read past the length limit
+            line = req.stream.readline(remaining + 1)
+            if not line:
+                return rows
+            remaining -= len(line)
+            if remaining < 0:
+                raise RequestEntityTooLarge()
+            line = line.strip()
+            if not line:
+                continue
+            if len(rows) == max_rows:
+                raise ValueError('too many rows')
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                rows.append(None)
+
+    if not req.is_json:
+        raise ValueError('json array is expected')
+    data = req.stream.read(max_length + 1)
+    if len(data) > max_length:
+        raise RequestEntityTooLarge()
+    try:
+        rows = json.loads(data)
+    except ValueError:
+        raise ValueError('json array is expected')
+    if not isinstance(rows, list) or len(rows) > max_rows:
+        raise ValueError('json array is expected')
+    return rows
+
+
+def validate_clothes_row(row):
+    """Validate one row of POST /clothes/bulk the way POST /clothes does.
+
+    Returns: tuple of clothes data to insert and error message, one of
+             which is None
+    """
+    if not isinstance(row, dict) or 'type' not in row or 'size' not in row:
+        return None, 'bad request'
+    clothes_type = row['type']
+    try:
+        size = float(row['size'])
+    except (TypeError, ValueError):
+        return None, 'umprocessable'
+    # float() also reads 'nan' and 'inf'
+    if not math.isfinite(size):
+        return None, 'umprocessable'
+    if not isinstance(clothes_type, str) or not 0 < len(clothes_type) <= 120:
+        return None, 'umprocessable'
+    return {'type': clothes_type, 'size': size, 'status': ''}, None
+
+
+def conditional(table):
+    """Decorator of GET handlers which answer with the rows of a table.
+    The response is tagged with the version of the table, and a request
+    whose If-None-Match has that tag is answered with 304 Not Modified
+    without calling the handler.
+    """
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = '{}-{}'.format(table, table_version(table))
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = f(*args, **kwargs)
+            response.set_etag(etag)
+            return response
+
+        return wrapper
+    return conditional_decorator
 
 
 def create_app(test_config=None):
@@ -13,6 +265,9 @@ def create_app(test_config=None):
     setup_db(app)
     cors = CORS(app, resource={r'*': '*'})
 
+    # Request metrics
+    app.before_request(start_request)
+
     # CORS Headers
     @app.after_request
     def after_request(response):
@@ -24,7 +279,21 @@ def create_app(test_config=None):
             'Access-Control-Allow-Methods',
             'GET, POST, PATCH, DELETE, OPTIONS'
             )
-        return response
+        # this hook runs last, so the timings cover the other hooks too
+        return finish_request(response)
+
+    # Response compression negotiated through Accept-Encoding
+    app.after_request(compress_response)
+
+    # Clients which have written read their writes from the primary
+    app.extensions['write_marks'] = write_marks
+    app.after_request(mark_writes)
+
+    # Each request is a unit of work, committed unless it fails. This
+    # hook runs first, so the response is sent only once it is committed
+    app.before_request(start_unit_of_work)
+    app.after_request(finish_unit_of_work)
+    app.teardown_request(end_unit_of_work)
 
     # ---------------------------------------- #
     # Endpoints
@@ -34,12 +303,33 @@ def create_app(test_config=None):
         # return render_template('pages/home.html')
         return 'Welcome to Kinder Reuse Closet!'
 
+    @app.route('/metrics')
+    @requires_auth('get:metrics')
+    def export_metrics(payload):
+        """Export request, SQL and cache metrics in the Prometheus text
+        format. Only clients with the get:metrics permission may read
+        them, like the monitoring of the deployment.
+        """
+        return Response(
+            registry.render(),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
+
     # Clothes
     # ----------------------------------------
     @app.route('/clothes')
     @requires_auth('get:clothes')
+    @query_budget(LIST_CLOTHES_BUDGET)
+    @read_only()
+    @conditional('clothes')
+    @cached('clothes')
     def retrieve_clothes(payload):
         """Get clothes from our database server.
+        Clothes can be filtered by type, min_size, max_size, status and
+        registered_since in the query string. With 'limit' or 'cursor',
+        clothes are returned page by page in order of id. With
+        'stream=true', all clothes are streamed instead. Without either,
+        more than MAX_UNPAGED_SIZE clothes are returned as the first page
+        of that size.
 
         Returns: json object with following attributes
         {
@@ -47,21 +337,70 @@ def create_app(test_config=None):
             'total': num of clothes stored in our server,
             'clothes': array of each formatted clothes
         }
+        or, when paginated,
+        {
+            'success': True,
+            'clothes': array of formatted clothes on this page,
+            'next_cursor': cursor of the next page, null on the last page,
+            'total': num of clothes, only if 'total=true' is given
+        }
         """
-        selection = Clothes.query.order_by(Clothes.id).all()
-        clothes = []
-        for item in selection:
-            formatted_clothes = item.format()
-            clothes.append(formatted_clothes)
+        try:
+            query = filter_clothes(Clothes.query, request.args)
+        except ValueError:
+            abort(400)
 
-        return jsonify({
+        if 'limit' not in request.args and 'cursor' not in request.args:
+            if request.args.get('stream') == 'true':
+                return stream_collection(
+                    'clothes',
+                    query.order_by(Clothes.id),
+                    clothes_serializer)
+            max_size = app.config.get('MAX_UNPAGED_SIZE', MAX_UNPAGED_SIZE)
+            # fetch one more row to find out if the result has to be paged
+            selection = clothes_serializer.project(query)\
+                .order_by(Clothes.id).limit(max_size + 1).all()
+            if len(selection) > max_size:
+                selection = selection[:max_size]
+                return json_response({
+                    'success': True,
+                    'clothes': clothes_serializer.format_all(selection),
+                    'next_cursor': encode_cursor(selection[-1].id)
+                })
+            clothes = clothes_serializer.format_all(selection)
+
+            return json_response({
+                'success': True,
+                'total': len(clothes),
+                'clothes': clothes
+            })
+
+        try:
+            limit, last_id = get_page_args(request.args)
+        except ValueError:
+            abort(400)
+        # fetch one more row to find out if there is a next page
+        selection = clothes_serializer.project(query)\
+            .filter(Clothes.id > last_id)\
+            .order_by(Clothes.id).limit(limit + 1).all()
+        next_cursor = None
+        if len(selection) > limit:
+            selection = selection[:limit]
+            next_cursor = encode_cursor(selection[-1].id)
+        clothes = clothes_serializer.format_all(selection)
+
+        response = {
             'success': True,
-            'total': len(clothes),
-            'clothes': clothes
-        })
+            'clothes': clothes,
+            'next_cursor': next_cursor
+        }
+        if request.args.get('total') == 'true':
+            response['total'] = query.count()
+        return json_response(response)
 
     @app.route('/clothes', methods=['POST'])
     @requires_auth('post:clothes')
+    @query_budget(CREATE_BUDGET)
     def create_clothes(payload):
         """Post a new clothes to our database server.
 
@@ -93,22 +432,83 @@ def create_app(test_config=None):
             clothes.insert()
             formatted_clothes = clothes.format()
         except Exception:
-            clothes.rollback()
             error = True
             print(sys.exc_info())
-        finally:
-            clothes.close_session()
 
         if error:
             abort(422)
         else:
             return jsonify({
                 'success': True,
-                'clothes': clothes.format()
+                'clothes': formatted_clothes
             })
 
+    @app.route('/clothes/bulk', methods=['POST'])
+    @requires_auth('post:clothes')
+    def create_clothes_in_bulk(payload):
+        """Post many new clothes to our database server at once.
+        The body is a json array or newline delimited json of clothes
+        with type and size. Valid rows are registered in a single
+        transaction, invalid rows are reported by their index.
+
+        Returns: json object with following attributes
+        {
+            'success': True,
+            'total': num of clothes which have been just created,
+            'clothes': array of index of the row and id of created clothes,
+            'errors': array of index of the row and error message
+        }
+        """
+        try:
+            rows = read_bulk_rows(
+                request,
+                app.config.get('MAX_BULK_SIZE', MAX_BULK_SIZE),
+                app.config.get(
+                    'MAX_BULK_CONTENT_LENGTH', MAX_BULK_CONTENT_LENGTH))
+        except ValueError:
+            abort(400)
+        # empty request is a bad request
+        if not rows:
+            abort(400)
+
+        # validate all rows
+        valid_rows = []
+        indexes = []
+        errors = []
+        for index, row in enumerate(rows):
+            data, message = validate_clothes_row(row)
+            if message is not None:
+                errors.append({'row': index, 'message': message})
+            else:
+                valid_rows.append(data)
+                indexes.append(index)
+
+        # register valid clothes at once
+        error = False
+        ids = []
+        try:
+            if valid_rows:
+                ids = Clothes.insert_many(valid_rows)
+        except Exception:
+            error = True
+            print(sys.exc_info())
+
+        if error:
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'total': len(ids),
+            'clothes': [
+                {'row': index, 'id': clothes_id}
+                for index, clothes_id in zip(indexes, ids)
+            ],
+            'errors': errors
+        })
+
     @app.route('/clothes/<int:clothes_id>', methods=['PATCH'])
     @requires_auth('patch:clothes')
+    @query_budget(UPDATE_BUDGET)
     def update_clothes_data(payload, clothes_id):
         """Update clothes data of given id.
 
@@ -138,11 +538,8 @@ def create_app(test_config=None):
             clothes.update()
             formatted_clothes = clothes.format()
         except Exception:
-            clothes.rollback()
             error = True
             print(sys.exc_info())
-        finally:
-            clothes.close_session()
 
         if error:
             abort(422)
@@ -154,6 +551,7 @@ def create_app(test_config=None):
 
     @app.route('/clothes/<int:clothes_id>', methods=['DELETE'])
     @requires_auth('delete:clothes')
+    @query_budget(DELETE_BUDGET)
     def delete_clothes(payload, clothes_id):
         """Delete the given clothes.
 
@@ -173,11 +571,8 @@ def create_app(test_config=None):
         try:
             clothes.delete()
         except Exception:
-            clothes.rollback()
             error = True
             print(sys.exc_info())
-        finally:
-            clothes.close_session()
 
         if error:
             abort(422)
@@ -189,6 +584,8 @@ def create_app(test_config=None):
 
     @app.route('/clothes/<int:clothes_id>/reservations')
     @requires_auth('get:reservations')
+    @query_budget(CLOTHES_RESERVATIONS_BUDGET)
+    @read_only()
     def retrieve_clothes_reservations(payload, clothes_id):
         """retrieve reservation information about that clothes.
         Users can check theri own reservation information. AUthError will
@@ -211,8 +608,8 @@ def create_app(test_config=None):
             abort(422)
         reservation = selection[0]
 
-        # querying who is accessing and check role
-        access_user = User.query.filter_by(auth0_id=payload['sub']).first()
+        # resolve who is accessing and check role
+        access_user = get_access_user()
         role = access_user.role
         # if user role is "user", check if access user_id matches
         # reservation user_id
@@ -226,7 +623,7 @@ def create_app(test_config=None):
         # query clothes
         clothes = reservation.clothes
 
-        return jsonify({
+        return json_response({
             'success': True,
             'clothes': clothes.format(),
             'user': reserved_user.format()
@@ -234,6 +631,7 @@ def create_app(test_config=None):
 
     @app.route('/clothes/<int:clothes_id>/reservations', methods=['POST'])
     @requires_auth('post:reservations')
+    @query_budget(RESERVE_BUDGET)
     def reserve_clothes(payload, clothes_id):
         """Make a reservation.
 
@@ -257,37 +655,36 @@ def create_app(test_config=None):
         if body['auth0_id'] != payload['sub']:
             abort(401)
 
-        # query user
-        user = User.query.filter_by(auth0_id=payload['sub']).first()
-
-        # query clothes
-        clothes = Clothes.query.get(clothes_id)
-        if clothes is None:
-            abort(404)
-        # if the clothes has already been reserved, abort 422
-        if clothes.status == "reserved":
-            abort(422)
+        # resolve who is reserving, usually without a query
+        access_user = get_access_user()
 
         # store reservation data in database
         try:
-            reservation = Reserve()
-            reservation.clothes = clothes
-            reservation.user = user
-            clothes.status = "reserved"
-            reservation.insert()
+            # claim the clothes with a single conditional UPDATE so
+            # that only one of concurrent requests can succeed
+            claimed = Clothes.claim(clothes_id)
+            if claimed:
+                clothes = Clothes.query.get(clothes_id)
+                reservation = Reserve()
+                reservation.clothes = clothes
+                reservation.user_id = access_user.id
+                reservation.insert()
 
-            formatted_clothes = clothes.format()
-            formatted_user = user.format()
+                # the user is loaded only for the response
+                formatted_clothes = clothes.format()
+                formatted_user = User.query.get(access_user.id).format()
         except Exception:
-            reservation.rollback()
             error = True
             print(sys.exc_info())
-        finally:
-            reservation.close_session()
-            clothes.close_session()
 
         if error:
             abort(422)
+        elif not claimed:
+            # if the clothes does not exist, abort 404
+            if Clothes.query.get(clothes_id) is None:
+                abort(404)
+            # the clothes has already been reserved, abort 422
+            abort(422)
         else:
             return jsonify({
                 'success': True,
@@ -297,6 +694,7 @@ def create_app(test_config=None):
 
     @app.route('/clothes/<int:clothes_id>/reservations', methods=["DELETE"])
     @requires_auth('delete:reservations')
+    @query_budget(CANCEL_BUDGET)
     def cancel_reservation(payload, clothes_id):
         """Users can cancel their own reservations. AUthError will be
         returned if user_id is not match.
@@ -318,8 +716,8 @@ def create_app(test_config=None):
             abort(422)
         # check if access user_id matches reservation user_id
         reservation = selection[0]
-        # querying who is accessing and check role
-        access_user = User.query.filter_by(auth0_id=payload['sub']).first()
+        # resolve who is accessing and check role
+        access_user = get_access_user()
         role = access_user.role
         # if user role is "user", check if access user_id matches
         # reservation user_id
@@ -342,12 +740,8 @@ def create_app(test_config=None):
             formatted_clothes = clothes.format()
             formatted_user = reservation_user.format()
         except Exception:
-            reservation.rollback()
             error = True
             print(sys.exc_info())
-        finally:
-            reservation.close_session()
-            clothes.close_session()
 
         if error:
             abort(422)
@@ -362,8 +756,13 @@ def create_app(test_config=None):
     # ----------------------------------------
     @app.route('/users')
     @requires_auth('get:users')
+    @query_budget(LIST_USERS_BUDGET)
+    @read_only()
+    @conditional('users')
+    @cached('users')
     def retrieve_users(payload):
         """Get users from our database server.
+        With 'stream=true' in the query string, users are streamed.
 
         Returns: json object with following attributes
         {
@@ -372,13 +771,17 @@ def create_app(test_config=None):
             'users': array of each formatted users
         }
         """
-        selection = User.query.order_by(User.id).all()
-        users = []
-        for item in selection:
-            formatted_user = item.format()
-            users.append(formatted_user)
+        if request.args.get('stream') == 'true':
+            return stream_collection(
+                'users',
+                User.query.order_by(User.id),
+                user_serializer)
 
-        return jsonify({
+        selection = user_serializer.project(User.query)\
+            .order_by(User.id).all()
+        users = user_serializer.format_all(selection)
+
+        return json_response({
             'success': True,
             'total': len(users),
             'users': users
@@ -386,6 +789,7 @@ def create_app(test_config=None):
 
     @app.route('/users', methods=['POST'])
     @requires_auth('post:users')
+    @query_budget(CREATE_BUDGET)
     def create_user(payload):
         """Create a new user.
 
@@ -428,11 +832,8 @@ def create_app(test_config=None):
             user.insert()
             formatted_user = user.format()
         except Exception:
-            user.rollback()
             error = True
             print(sys.exc_info())
-        finally:
-            user.close_session()
 
         if error:
             abort(422)
@@ -444,6 +845,7 @@ def create_app(test_config=None):
 
     @app.route('/users/<int:user_id>', methods=['PATCH'])
     @requires_auth('patch:users')
+    @query_budget(UPDATE_BUDGET)
     def update_user_data(payload, user_id):
         """Update user date of given id.
 
@@ -475,11 +877,8 @@ def create_app(test_config=None):
             user.update()
             formatted_user = user.format()
         except Exception:
-            user.rollback()
             error = True
             print(sys.exc_info())
-        finally:
-            user.close_session()
 
         if error:
             abort(422)
@@ -491,6 +890,7 @@ def create_app(test_config=None):
 
     @app.route('/users/<int:user_id>', methods=['DELETE'])
     @requires_auth('delete:users')
+    @query_budget(DELETE_BUDGET)
     def delete_user(payload, user_id):
         """Delete the given user.
 
@@ -510,11 +910,8 @@ def create_app(test_config=None):
         try:
             user.delete()
         except Exception:
-            user.rollback()
             error = True
             print(sys.exc_info())
-        finally:
-            user.close_session()
 
         if error:
             abort(422)
@@ -526,6 +923,8 @@ def create_app(test_config=None):
 
     @app.route('/users/<int:user_id>/reservations')
     @requires_auth('get:reservations')
+    @query_budget(USER_RESERVATIONS_BUDGET)
+    @read_only()
     def retrieve_user_reservations(payload, user_id):
         """Get all reservations which the given user has made.
         Users can get reservations only through their own user_id.
@@ -545,8 +944,8 @@ def create_app(test_config=None):
         user = User.query.get(user_id)
         if user is None:
             abort(404)
-        # querying who is accessing and check role
-        access_user = User.query.filter_by(auth0_id=payload['sub']).first()
+        # resolve who is accessing and check role
+        access_user = get_access_user()
         role = access_user.role
         # if user role is "user", check if access user_id matches
         if role == 'user' and access_user.id != user_id:
@@ -555,14 +954,13 @@ def create_app(test_config=None):
                 'description': 'Unauthorized access by user'
             }, 401)
 
-        # query reserations
-        reservations = Reserve.query.filter_by(user_id=user_id).all()
-        # query clothes
-        clothes = []
-        for reservation in reservations:
-            clothes.append(reservation.clothes.format())
+        # query the reserved clothes in a single query
+        selection = clothes_serializer.project(Clothes.query)\
+            .join(Reserve).filter(Reserve.user_id == user_id)\
+            .order_by(Reserve.id).all()
+        clothes = clothes_serializer.format_all(selection)
 
-        return jsonify({
+        return json_response({
             'success': True,
             'clothes': clothes,
             'user': user.format()
@@ -570,6 +968,7 @@ def create_app(test_config=None):
 
     @app.route('/users/<int:user_id>/reservations', methods=['POST'])
     @requires_auth('post:reservations')
+    @query_budget(RESERVE_BUDGET)
     def create_reservations(payload, user_id):
         """Post reservations to our server. Users can post reservations
         through their own user_id. AuthError will be returned if trying
@@ -599,8 +998,8 @@ def create_app(test_config=None):
         if body['auth0_id'] != payload['sub']:
             abort(401)
 
-        # query who is accessing
-        access_user = User.query.filter_by(auth0_id=payload['sub']).first()
+        # resolve who is accessing
+        access_user = get_access_user()
         # check if user_id in URL matches the access user id
         if user_id != access_user.id:
             raise AuthError({
@@ -614,46 +1013,48 @@ def create_app(test_config=None):
         for value in body['reservations']:
             if not isinstance(value, int):
                 abort(400)
-        # check if all clothes indeed exist
-        clothes = []
-        for clothes_id in body['reservations']:
-            # query clothes
-            selection = Clothes.query.get(clothes_id)
-            if selection is None:
-                abort(404)
-            # if that clothes has been already reserved, abort 422
-            if selection.status == "reserved":
-                abort(422)
-            clothes.append(selection)
+        clothes_ids = body['reservations']
+        # the same clothes cannot be reserved twice, abort 422
+        if len(set(clothes_ids)) != len(clothes_ids):
+            abort(422)
 
         # query user
         user = User.query.get(user_id)
         formatted_user = user.format()
 
-        # make reservations
+        # lock all requested clothes with a single query, in order of id
+        # so that concurrent requests cannot deadlock, and keep them
+        # locked until the reservations are committed
+        clothes = {}
+        if clothes_ids:
+            selection = Clothes.query.filter(Clothes.id.in_(clothes_ids))\
+                .order_by(Clothes.id).with_for_update().all()
+            clothes = {item.id: item for item in selection}
+        # check if all clothes indeed exist
+        if len(clothes) != len(clothes_ids):
+            abort(404)
+        # if any of clothes has been already reserved, abort 422
+        for item in clothes.values():
+            if item.status == "reserved":
+                abort(422)
+
+        # make reservations in a single transaction
         try:
             reservations = []
             formatted_clothes = []
-            for item in clothes:
-                new_reservation = Reserve()
-                new_reservation.user = user
-                new_reservation.clothes = item
+            for clothes_id in clothes_ids:
+                item = clothes[clothes_id]
                 item.status = "reserved"
-                reservations.append(new_reservation)
-            # commit these reservations
-            for reservation in reservations:
-                reservation.insert()
-                formatted_clothes.append(reservation.clothes.format())
+                reservations.append({
+                    'clothes_id': item.id,
+                    'user_id': user.id
+                })
+                formatted_clothes.append(item.format())
+            # one executemany instead of one INSERT per reservation
+            Reserve.insert_all(reservations)
         except Exception:
-            # rollback all sessions
-            for reservation in reservations:
-                reservation.rollback()
             error = True
             print(sys.exc_info())
-        finally:
-            # close all sessions
-            for reservation in reservations:
-                reservation.close_session()
 
         if error:
             abort(422)
@@ -666,6 +1067,7 @@ def create_app(test_config=None):
 
     @app.route('/users/<int:user_id>/reservations', methods=['DELETE'])
     @requires_auth('delete:reservations')
+    @query_budget(CANCEL_BUDGET)
     def delete_reservations(payload, user_id):
         """Delete all reservations which the given user has made.
         Users can delete reservations through their own user_id.
@@ -685,8 +1087,8 @@ def create_app(test_config=None):
         user = User.query.get(user_id)
         if user is None:
             abort(404)
-        # querying who is accessing and check role
-        access_user = User.query.filter_by(auth0_id=payload['sub']).first()
+        # resolve who is accessing and check role
+        access_user = get_access_user()
         role = access_user.role
         # if user role is "user", check if access user_id matches
         if role == 'user' and access_user.id != user_id:
@@ -695,28 +1097,14 @@ def create_app(test_config=None):
                 'description': 'Unauthorized access by user'
             }, 401)
 
-        # delete reservations
+        # delete reservations and release their clothes at once
         error = False
         formatted_user = user.format()
-        reservations = Reserve.query.filter_by(user_id=user_id)\
-            .order_by(Reserve.clothes_id).all()
         try:
-            formatted_clothes = []
-            for reservation in reservations:
-                clothes = reservation.clothes
-                clothes.status = ""
-                formatted_clothes.append(clothes.format())
-            # commit deletion
-            for reservation in reservations:
-                reservation.delete()
+            formatted_clothes = Reserve.cancel_all(user_id)
         except Exception:
-            for reservation in reservations:
-                reservation.rollback()
             error = True
             print(sys.exc_info())
-        finally:
-            for reservation in reservations:
-                reservation.close_session()
 
         if error:
             abort(422)
@@ -771,6 +1159,14 @@ def create_app(test_config=None):
             'message': 'method not allowed'
         }), 405
 
+    @app.errorhandler(413)
+    def request_entity_too_large(error):
+        return jsonify({
+            'success': False,
+            'error': 413,
+            'message': 'request entity too large'
+        }), 413
+
     @app.errorhandler(422)
     def umprocessable(error):
         return jsonify({
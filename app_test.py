@@ -1,10 +1,39 @@
+import asyncio
+import gzip
+import io
 import json
+import random
+import shutil
+import tempfile
+import time
 import unittest
 import os
+import rsa
+from flask import Flask, Response, abort, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
-
-from app import create_app
-from models import setup_db, db
+from jose import jwk, jwt
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import NullPool
+from werkzeug.datastructures import MultiDict
+from datetime import datetime
+
+from app import create_app, encode_cursor
+from models import setup_db, db, unit_of_work, read_only, get_engine_options
+from models import Clothes, User, Reserve, TableVersion
+from auth import JWKSCache, TokenCache, AccessUserCache, AccessUser
+from auth import access_user_cache
+from cache import CacheBackend, LocalBackend, ResponseCache, response_cache
+from cache import write_marks
+import compression
+from compression import COMPRESSION_MIN_SIZE, compress_response
+from metrics import count_queries, query_budget, start_request
+from metrics import QueryBudgetExceeded, query_budget_exceeded
+from serializers import ENCODERS, dumps, http_date, json_response
+from serializers import clothes_serializer
+import datagen
+from asgi import ASGIAdapter
+from benchmarks.jwks_stub import JWKSStub
+from benchmarks.load import compare, percentile
 
 DATABASE_URL = os.environ['TEST_DATABASE_URL']
 
@@ -18,6 +47,10 @@ class ClosetAppTestCase(unittest.TestCase):
         self.client = self.app.test_client
         self.database_path = DATABASE_URL
         setup_db(self.app, self.database_path)
+        # fail every request which goes over the query budget of its
+        # endpoint, with the QueryBudgetExceeded error itself
+        self.app.config['QUERY_BUDGET'] = 'raise'
+        self.app.config['PROPAGATE_EXCEPTIONS'] = True
 
         # bind the app to the current context
         with self.app.app_context():
@@ -151,6 +184,40 @@ class ClosetAppTestCase(unittest.TestCase):
         """Excecuted after reach test"""
         pass
 
+    def explain_queries(self, path, headers):
+        """Returns: query plans of the SELECT statements of a GET request"""
+        statements = []
+
+        def record_select(conn, cursor, statement, parameters, *args):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        with self.app.app_context():
+            engine = self.db.engine
+        event.listen(engine, 'before_cursor_execute', record_select)
+        try:
+            res = self.client().get(path, headers=headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record_select)
+        self.assertEqual(res.status_code, 200)
+
+        plans = []
+        with engine.connect() as conn, conn.begin():
+            if engine.dialect.name == 'postgresql':
+                # the test tables are too small for the planner to bother
+                # with indexes otherwise
+                conn.execute('SET LOCAL enable_seqscan = off')
+                explain = 'EXPLAIN '
+            else:
+                explain = 'EXPLAIN QUERY PLAN '
+            for statement, parameters in statements:
+                rows = conn.execute(explain + statement, parameters)
+                plans.append((
+                    statement,
+                    ' '.join(str(value) for row in rows for value in row)
+                    ))
+        return plans
+
     # Test for public access
     # ------------------------------------------------
     # ------------------------------
@@ -502,6 +569,318 @@ class ClosetAppTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "Invalid_claims")
 
+    def test_user_10_retrieve_clothes_by_page(self):
+        """GET /clothes?limit=<n>&cursor=<cursor>
+        Test retrieving clothes page by page with user JWT.
+        """
+        res = self.client().get(
+            '/clothes?limit=1&total=true',
+            headers=self.user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['clothes']), 1)
+        self.assertEqual(data['clothes'][0]['id'], self.clothes_id)
+        self.assertEqual(data['total'], 2)
+
+        res = self.client().get(
+            '/clothes?limit=1&cursor={}'.format(data['next_cursor']),
+            headers=self.user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['clothes'][0]['id'], self.extra_clothes_id)
+        self.assertIsNone(data['next_cursor'])
+        self.assertNotIn('total', data)
+
+    def test_user_11_retrieve_clothes_by_malformed_page(self):
+        """GET /clothes?limit=<n>&cursor=<cursor>
+        Malformed limit or cursor is a bad request.
+        """
+        for query in ['limit=0', 'limit=abc', 'cursor=abc',
+                      'cursor=' + encode_cursor(True)]:
+            res = self.client().get(
+                '/clothes?{}'.format(query),
+                headers=self.user_headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+
+    def test_user_12_retrieve_filtered_clothes(self):
+        """GET /clothes?type=<type>&min_size=<size>&status=<status>
+        Test retrieving clothes narrowed by filters with user JWT.
+        """
+        res = self.client().get(
+            '/clothes?type=pants&min_size=110&max_size=130',
+            headers=self.user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['clothes'][0]['id'], self.extra_clothes_id)
+
+        res = self.client().get(
+            '/clothes?status=available&registered_since=2020-12-01',
+            headers=self.user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [item['id'] for item in data['clothes']],
+            [self.extra_clothes_id])
+
+        res = self.client().get(
+            '/clothes?status=reserved&limit=10&total=true',
+            headers=self.user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['clothes'][0]['id'], self.clothes_id)
+
+    def test_user_13_retrieve_clothes_by_malformed_filter(self):
+        """GET /clothes?min_size=<size>&status=<status>
+        Malformed filter is a bad request.
+        """
+        for query in ['min_size=abc', 'status=lost', 'registered_since=x']:
+            res = self.client().get(
+                '/clothes?{}'.format(query),
+                headers=self.user_headers)
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_user_14_stream_clothes(self):
+        """GET /clothes?stream=true
+        Test streaming all clothes with user JWT.
+        """
+        res = self.client().get(
+            '/clothes?stream=true&type=shirt',
+            headers=self.user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['clothes'], [self.reservation['clothes']])
+
+    def test_user_15_forbidden_reserve_reserved_clothes(self):
+        """POST /clothes/<id>/reservations
+        Reserved or not existing clothes cannot be reserved.
+        """
+        res = self.client().post(
+            'clothes/{}/reservations'.format(self.clothes_id),
+            json={"auth0_id": self.user_auth0_id},
+            headers=self.user_headers)
+
+        self.assertEqual(res.status_code, 422)
+
+        res = self.client().post(
+            'clothes/{}/reservations'.format(self.extra_clothes_id + 1000),
+            json={"auth0_id": self.user_auth0_id},
+            headers=self.user_headers)
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_user_16_claim_clothes_once(self):
+        """Clothes can be claimed only once."""
+        with self.app.app_context():
+            self.assertEqual(Clothes.claim(self.clothes_id), False)
+            # nothing has changed, so cached clothes stay valid
+            touched = self.db.session.info.get('touched', set())
+            self.assertNotIn('clothes', touched)
+            self.assertEqual(Clothes.claim(self.extra_clothes_id), True)
+            self.assertIn('clothes', self.db.session.info['touched'])
+            self.assertEqual(Clothes.claim(self.extra_clothes_id), False)
+            self.db.session.rollback()
+
+    def test_user_17_filtered_clothes_use_indexes(self):
+        """GET /clothes
+        Filtered clothes are looked up by indexes.
+        """
+        cases = [
+            ('/clothes?type=shirt', 'ix_clothes_type_size'),
+            ('/clothes?status=reserved', 'ix_clothes_status_registered_time'),
+            ('/clothes?status=available&limit=10', 'ix_clothes_available')
+        ]
+        for path, index in cases:
+            plans = [
+                plan for statement, plan
+                in self.explain_queries(path, self.user_headers)
+                if 'FROM clothes' in statement]
+
+            self.assertEqual(len(plans), 1)
+            self.assertIn(index, plans[0])
+
+    def test_user_18_conditional_retrieve_clothes(self):
+        """GET /clothes
+        Unchanged clothes are answered with 304 Not Modified.
+        """
+        res = self.client().get('/clothes', headers=self.user_headers)
+        etag = res.headers['ETag']
+
+        self.assertEqual(res.status_code, 200)
+
+        headers = dict(self.user_headers, **{'If-None-Match': etag})
+        res = self.client().get('/clothes', headers=headers)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+        # cancelling the reservation changes the status of the clothes
+        self.client().delete(
+            '/clothes/{}/reservations'.format(self.clothes_id),
+            json={"auth0_id": self.user_auth0_id},
+            headers=self.user_headers)
+        res = self.client().get('/clothes', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_user_19_cached_retrieve_clothes(self):
+        """GET /clothes
+        Repeated reads are served from the cache until the clothes change.
+        """
+        response_cache.clear()
+        first = self.client().get('/clothes', headers=self.user_headers)
+        second = self.client().get('/clothes', headers=self.user_headers)
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(response_cache.stats(), {'hits': 1, 'misses': 1})
+
+        res = self.client().post(
+            'clothes/{}/reservations'.format(self.extra_clothes_id),
+            json={"auth0_id": self.user_auth0_id},
+            headers=self.user_headers)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/clothes', headers=self.user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(
+            [item['status'] for item in data['clothes']],
+            ['reserved', 'reserved'])
+
+    def test_user_20_request_metrics(self):
+        """GET /clothes, GET /metrics
+        Requests are timed in Server-Timing and exported as metrics.
+        """
+        self.app.config['SERVER_TIMING'] = True
+        res = self.client().get('/clothes', headers=self.user_headers)
+        timings = res.headers['Server-Timing']
+
+        self.assertIn('auth;dur=', timings)
+        self.assertIn('serialize;dur=', timings)
+        self.assertIn('db;dur=', timings)
+        self.assertIn('app;dur=', timings)
+
+        res = self.client().get('/metrics', headers=self.manager_headers)
+        text = res.data.decode('utf-8')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(
+            'closet_requests_total{method="GET",endpoint="/clothes",'
+            'status="200"}', text)
+        self.assertIn(
+            'closet_sql_statements_per_request_count{method="GET",'
+            'endpoint="/clothes"}', text)
+        self.assertIn(
+            'closet_phase_duration_seconds_bucket{phase="auth"', text)
+        self.assertIn('closet_response_cache_hits_total', text)
+
+    def test_user_21_retrieve_large_clothes_by_page(self):
+        """GET /clothes
+        Too many clothes without paging arguments are returned by page.
+        """
+        self.app.config['MAX_UNPAGED_SIZE'] = 1
+        res = self.client().get('/clothes', headers=self.user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [item['id'] for item in data['clothes']], [self.clothes_id])
+        self.assertNotIn('total', data)
+
+        res = self.client().get(
+            '/clothes?cursor={}'.format(data['next_cursor']),
+            headers=self.user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(
+            [item['id'] for item in data['clothes']],
+            [self.extra_clothes_id])
+        self.assertIsNone(data['next_cursor'])
+
+        self.app.config['MAX_UNPAGED_SIZE'] = 2
+        response_cache.clear()
+        res = self.client().get('/clothes', headers=self.user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['total'], 2)
+
+    def test_user_22_losing_claim_is_rolled_back(self):
+        """POST /clothes/<id>/reservations
+        A request which loses the claim commits nothing.
+        """
+        events = []
+
+        def record_commit(session):
+            events.append('commit')
+
+        def record_rollback(session):
+            events.append('rollback')
+        event.listen(self.db.session, 'after_commit', record_commit)
+        event.listen(self.db.session, 'after_rollback', record_rollback)
+        res = self.client().post(
+            'clothes/{}/reservations'.format(self.clothes_id),
+            json={"auth0_id": self.user_auth0_id},
+            headers=self.user_headers)
+        event.remove(self.db.session, 'after_commit', record_commit)
+        event.remove(self.db.session, 'after_rollback', record_rollback)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertNotIn('commit', events)
+        self.assertIn('rollback', events)
+
+    def test_user_23_losing_reservation_does_not_load_user(self):
+        """POST /clothes/<id>/reservations
+        The reserving user is loaded only for the response of a claim
+        which has succeeded.
+        """
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+        with self.app.app_context():
+            engine = self.db.get_engine()
+        # resolve the accessing user into the cache first
+        self.client().get('/clothes', headers=self.user_headers)
+        event.listen(engine, 'before_cursor_execute', record_statement)
+        res = self.client().post(
+            'clothes/{}/reservations'.format(self.clothes_id),
+            json={"auth0_id": self.user_auth0_id},
+            headers=self.user_headers)
+        event.remove(engine, 'before_cursor_execute', record_statement)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(
+            [statement for statement in statements if 'users' in statement])
+
+    def test_user_24_forbidden_metrics(self):
+        """GET /metrics
+        Metrics and timings are not shown to every client.
+        """
+        res = self.client().get('/clothes', headers=self.user_headers)
+
+        self.assertNotIn('Server-Timing', res.headers)
+        self.assertEqual(self.client().get('/metrics').status_code, 401)
+        res = self.client().get('/metrics', headers=self.staff_headers)
+        self.assertEqual(res.status_code, 401)
+
     # ------------------------------
     # access to users endpoints
     # ------------------------------
@@ -646,6 +1025,65 @@ class ClosetAppTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "Invalid_claims")
 
+    def test_user_10_forbidden_partial_reservations(self):
+        """POST /users/<id>/reservations
+        Reservations are not made at all if any of clothes is reserved.
+        """
+        for reservations in [
+                [self.extra_clothes_id, self.clothes_id],
+                [self.extra_clothes_id, self.extra_clothes_id]]:
+            res = self.client().post(
+                'users/{}/reservations'.format(self.user_id),
+                json={
+                    "auth0_id": self.user_auth0_id,
+                    "reservations": reservations
+                },
+                headers=self.user_headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 422)
+            self.assertEqual(data['success'], False)
+
+        res = self.client().get(
+            '/clothes?status=available',
+            headers=self.user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(
+            [item['id'] for item in data['clothes']],
+            [self.extra_clothes_id])
+
+    def test_user_11_reservations_serialized_like_models(self):
+        """GET /users/<id>/reservations
+        The listing is written the same as jsonify of formatted models.
+        """
+        res = self.client().get(
+            'users/{}/reservations'.format(self.user_id),
+            headers=self.user_headers)
+
+        with self.app.app_context():
+            expected = jsonify({
+                'success': True,
+                'clothes': [Clothes.query.get(self.clothes_id).format()],
+                'user': User.query.get(self.user_id).format()
+            }).get_data()
+        self.assertEqual(res.data, expected)
+
+    def test_user_12_reservations_use_indexes(self):
+        """GET /users/<id>/reservations
+        The accessing user and the reservations are looked up by indexes.
+        """
+        access_user_cache.clear()
+        plans = self.explain_queries(
+            'users/{}/reservations'.format(self.user_id),
+            self.user_headers)
+
+        access_user_plan = [
+            plan for statement, plan in plans if 'auth0_id =' in statement]
+        self.assertEqual(len(access_user_plan), 1)
+        self.assertIn('INDEX', access_user_plan[0].upper())
+        self.assertIn('ix_reserves_user_id', plans[-1][1])
+
     # Test for staff access
     # ------------------------------------------------
     # ------------------------------
@@ -758,6 +1196,111 @@ class ClosetAppTestCase(unittest.TestCase):
         self.assertEqual(data['clothes']['status'], "")
         self.assertEqual(data['user']['auth0_id'], self.user_auth0_id)
 
+    def test_staff_8_create_clothes_in_bulk(self):
+        """POST /clothes/bulk
+        Test creating many clothes at once with staff JWT.
+        """
+        res = self.client().post(
+            '/clothes/bulk',
+            json=[
+                {'type': 'shirt', 'size': '110'},
+                {'type': 'pants'},
+                {'type': 'shoes', 'size': 'large'},
+                {'type': 'shoes', 'size': 15.5}
+            ],
+            headers=self.staff_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total'], 2)
+        self.assertEqual([item['row'] for item in data['clothes']], [0, 3])
+        self.assertEqual(data['errors'], [
+            {'row': 1, 'message': 'bad request'},
+            {'row': 2, 'message': 'umprocessable'}
+        ])
+
+        res = self.client().get(
+            '/clothes?type=shoes',
+            headers=self.staff_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['clothes'][0]['size'], 15.5)
+        self.assertEqual(data['clothes'][0]['status'], '')
+        self.assertIsNotNone(data['clothes'][0]['registerd'])
+
+    def test_staff_9_create_clothes_in_bulk_from_ndjson(self):
+        """POST /clothes/bulk
+        Test creating many clothes from newline delimited json.
+        """
+        res = self.client().post(
+            '/clothes/bulk',
+            data='{"type": "hat", "size": 50}\n\nnot json\n',
+            content_type='application/x-ndjson',
+            headers=self.staff_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(
+            data['errors'],
+            [{'row': 1, 'message': 'bad request'}])
+
+        res = self.client().post(
+            '/clothes/bulk',
+            json={'type': 'hat', 'size': 50},
+            headers=self.staff_headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_staff_10_create_clothes_in_bulk_within_limits(self):
+        """POST /clothes/bulk
+        Newline delimited json is read only up to the row limit, and
+        large bodies are refused.
+        """
+        self.app.config['MAX_BULK_SIZE'] = 2
+        body = b'{"type": "hat", "size": 50}\n' * 10
+        stream = io.BytesIO(body)
+        res = self.client().post(
+            '/clothes/bulk',
+            input_stream=stream,
+            content_type='application/x-ndjson',
+            headers=dict(self.staff_headers, **{
+                'Content-Length': str(len(body))}))
+
+        self.assertEqual(res.status_code, 400)
+        self.assertLess(stream.tell(), len(body))
+
+        self.app.config['MAX_BULK_CONTENT_LENGTH'] = 40
+        for payload in [
+                {'data': body, 'content_type': 'application/x-ndjson'},
+                {'json': [{'type': 'hat', 'size': 50}] * 2}]:
+            res = self.client().post(
+                '/clothes/bulk', headers=self.staff_headers, **payload)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 413)
+            self.assertEqual(data['success'], False)
+
+    def test_staff_11_create_clothes_in_bulk_of_finite_size(self):
+        """POST /clothes/bulk
+        Sizes which are not finite numbers are unprocessable.
+        """
+        res = self.client().post(
+            '/clothes/bulk',
+            json=[
+                {'type': 'hat', 'size': 'nan'},
+                {'type': 'hat', 'size': '-inf'},
+                {'type': 'hat', 'size': '50'}
+            ],
+            headers=self.staff_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual([error['row'] for error in data['errors']], [0, 1])
+
     # ------------------------------
     # access to users endpoints
     # ------------------------------
@@ -874,6 +1417,22 @@ class ClosetAppTestCase(unittest.TestCase):
         self.assertEqual(data['clothes'][0]['status'], "")
         self.assertEqual(data['user']['auth0_id'], self.user_auth0_id)
 
+    def test_staff_8_stream_users(self):
+        """GET /users?stream=true
+        Test streaming all users with staff JWT.
+        """
+        res = self.client().get(
+            '/users',
+            headers=self.staff_headers)
+        expected = json.loads(res.data)
+        res = self.client().get(
+            '/users?stream=true',
+            headers=self.staff_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data, expected)
+
     # Test for manager access
     # ------------------------------------------------
     # ------------------------------
@@ -1103,6 +1662,1071 @@ class ClosetAppTestCase(unittest.TestCase):
         self.assertEqual(data['clothes'][0]['status'], "")
         self.assertEqual(data['user']['auth0_id'], self.user_auth0_id)
 
+    def test_manager_8_endpoints_declare_query_budgets(self):
+        """Every endpoint which reads or writes the database has a budget.
+        POST /clothes/bulk inserts row by row outside PostgreSQL.
+        """
+        exempt = (
+            'static', 'index', 'export_metrics', 'create_clothes_in_bulk')
+        for endpoint, view in self.app.view_functions.items():
+            if endpoint not in exempt:
+                self.assertTrue(hasattr(view, 'query_budget'), endpoint)
+
+    def test_manager_9_reservation_queries_do_not_grow(self):
+        """POST and DELETE /users/<id>/reservations
+        The number of statements does not grow with the reservations.
+        """
+        path = 'users/{}/reservations'.format(self.user_id)
+
+        def count_deleting():
+            access_user_cache.clear()
+            with count_queries() as queries:
+                res = self.client().delete(path, headers=self.manager_headers)
+            self.assertEqual(res.status_code, 200)
+            return queries.count
+
+        def count_posting(reservations):
+            access_user_cache.clear()
+            with count_queries() as queries:
+                res = self.client().post(
+                    path,
+                    json={
+                        "auth0_id": self.user_auth0_id,
+                        "reservations": reservations
+                    },
+                    headers=self.user_headers)
+            self.assertEqual(res.status_code, 200)
+            return queries.count
+
+        # one reservation made in setUp
+        deleting_one = count_deleting()
+        posting_one = count_posting([self.extra_clothes_id])
+        count_deleting()
+        posting_two = count_posting([self.clothes_id, self.extra_clothes_id])
+        deleting_two = count_deleting()
+
+        self.assertEqual(posting_one, posting_two)
+        self.assertEqual(deleting_one, deleting_two)
+
+    def test_manager_10_committed_user_changes_invalidate_access_users(self):
+        """A user changed through the models is resolved again once the
+        change is committed, and not when it is rolled back.
+        """
+        cached = AccessUser(self.user_id, 'user')
+        with self.app.app_context():
+            access_user_cache.put(self.user_auth0_id, cached)
+            with self.assertRaises(ValueError):
+                with unit_of_work():
+                    User.query.get(self.user_id).role = 'staff'
+                    self.db.session.flush()
+                    raise ValueError()
+            self.assertEqual(
+                access_user_cache.get(self.user_auth0_id), cached)
+
+            with unit_of_work():
+                User.query.get(self.user_id).address = 'Chiyoda-ku, Tokyo'
+            self.assertIsNone(access_user_cache.get(self.user_auth0_id))
+
+    def test_manager_11_conditional_retrieve_users(self):
+        """GET /users
+        Unchanged users are answered with 304 Not Modified.
+        """
+        res = self.client().get('/users', headers=self.manager_headers)
+        etag = res.headers['ETag']
+        headers = dict(self.manager_headers, **{'If-None-Match': etag})
+        res = self.client().get('/users', headers=headers)
+
+        self.assertEqual(res.status_code, 304)
+
+        self.client().patch(
+            '/users/{}'.format(self.user_id),
+            json={'address': 'Takanawa, Minato-ku, Tokyo'},
+            headers=self.manager_headers)
+        res = self.client().get('/users', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+
+def public_jwk(kid):
+    """Generate a throwaway RSA public key in JWK format."""
+    public_key, _ = rsa.newkeys(512)
+    key = jwk.construct(public_key.save_pkcs1(), 'RS256').to_dict()
+    key.update({'kid': kid, 'use': 'sig'})
+    return key
+
+
+class UnitOfWorkTestCase(unittest.TestCase):
+    """This class represents the unit of work test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        setup_db(self.app, DATABASE_URL)
+        with self.app.app_context():
+            db.create_all()
+
+    def test_changes_are_committed_once(self):
+        """Model helpers inside a unit of work share one transaction."""
+        with self.app.app_context():
+            commits = []
+
+            def count_commit(session):
+                commits.append(session)
+            event.listen(db.session, 'after_commit', count_commit)
+            with unit_of_work():
+                shirt = Clothes(type='shirt', size=100)
+                shirt.insert()
+                pants = Clothes(type='pants', size=110)
+                pants.insert()
+                with unit_of_work():
+                    shirt.update()
+            event.remove(db.session, 'after_commit', count_commit)
+
+            self.assertEqual(len(commits), 1)
+            self.assertIsNotNone(Clothes.query.get(pants.id))
+            shirt.delete()
+            pants.delete()
+
+    def test_versions_are_counted_with_the_work(self):
+        """The version rows are updated last in the transaction of the
+        work, and the work is not committed without them."""
+        with self.app.app_context():
+            steps = []
+
+            def record_statement(conn, cursor, statement, *args):
+                steps.append(statement.split(' ', 2)[:2])
+
+            def record_commit(conn):
+                steps.append(['COMMIT'])
+            engine = db.get_engine()
+            event.listen(engine, 'before_cursor_execute', record_statement)
+            event.listen(engine, 'commit', record_commit)
+            with unit_of_work():
+                shirt = Clothes(type='shirt', size=100)
+                shirt.insert()
+            event.remove(engine, 'before_cursor_execute', record_statement)
+            event.remove(engine, 'commit', record_commit)
+
+            self.assertEqual(steps, [
+                ['INSERT', 'INTO'], ['UPDATE', 'table_versions'],
+                ['COMMIT']])
+            shirt.delete()
+
+            def fail_versions(conn, cursor, statement, *args):
+                if statement.startswith('UPDATE table_versions'):
+                    raise ValueError()
+            version = TableVersion.get('clothes')
+            event.listen(engine, 'before_cursor_execute', fail_versions)
+            try:
+                with self.assertRaises(ValueError):
+                    with unit_of_work():
+                        pants = Clothes(type='pants', size=110)
+                        pants.insert()
+                        clothes_id = pants.id
+            finally:
+                event.remove(engine, 'before_cursor_execute', fail_versions)
+
+            self.assertIsNone(Clothes.query.get(clothes_id))
+            self.assertEqual(TableVersion.get('clothes'), version)
+
+    def test_changes_are_rolled_back_on_error(self):
+        """Nothing is committed if the unit of work raises."""
+        with self.app.app_context():
+            with self.assertRaises(ValueError):
+                with unit_of_work():
+                    shirt = Clothes(type='shirt', size=100)
+                    shirt.insert()
+                    clothes_id = shirt.id
+                    raise ValueError()
+
+            self.assertIsNone(Clothes.query.get(clothes_id))
+
+    def test_requests_are_units_of_work(self):
+        """A request is committed if it succeeds, and rolled back if it
+        is aborted or raises."""
+        @self.app.route('/work/<outcome>')
+        def work(outcome):
+            shirt = Clothes(type='work-' + outcome, size=100)
+            shirt.insert()
+            if outcome == 'abort':
+                abort(422)
+            if outcome == 'raise':
+                raise ValueError()
+            return 'ok'
+
+        client = self.app.test_client()
+        self.assertEqual(client.get('/work/succeed').status_code, 200)
+        self.assertEqual(client.get('/work/abort').status_code, 422)
+        self.assertEqual(client.get('/work/raise').status_code, 500)
+
+        with self.app.app_context():
+            types = [row.type for row in Clothes.query.filter(
+                Clothes.type.like('work-%'))]
+            Clothes.query.filter(Clothes.type.like('work-%')).delete(
+                synchronize_session=False)
+            db.session.commit()
+        self.assertEqual(types, ['work-succeed'])
+
+    def test_over_budget_writes_are_rolled_back(self):
+        """A raised QueryBudgetExceeded rolls back the request."""
+        self.app.config['QUERY_BUDGET'] = 'raise'
+        self.app.config['PROPAGATE_EXCEPTIONS'] = True
+
+        @self.app.route('/over-budget', methods=['POST'])
+        @query_budget(0)
+        def over_budget():
+            Clothes(type='shirt', size=1).insert()
+            return jsonify({'success': True})
+
+        with self.app.app_context():
+            count = Clothes.query.count()
+        with self.assertRaises(QueryBudgetExceeded):
+            self.app.test_client().post('/over-budget')
+        self.app.config['PROPAGATE_EXCEPTIONS'] = False
+        res = self.app.test_client().post('/over-budget')
+
+        self.assertEqual(res.status_code, 500)
+        with self.app.app_context():
+            self.assertEqual(Clothes.query.count(), count)
+
+
+class DatagenTestCase(unittest.TestCase):
+    """This class represents the synthetic data generator test case"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app()
+        setup_db(
+            self.app,
+            'sqlite:///' + os.path.join(self.directory, 'datagen.db'))
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.get_engine(self.app).dispose()
+        shutil.rmtree(self.directory)
+
+    def rows(self):
+        """Returns: generated rows without their ids"""
+        clothes = db.session.query(
+            Clothes.type, Clothes.size, Clothes.registered_time,
+            Clothes.status).order_by(Clothes.id).all()
+        users = db.session.query(User.auth0_id, User.role)\
+            .order_by(User.id).all()
+        reserves = db.session.query(Clothes.type, User.auth0_id)\
+            .join(Reserve, Reserve.clothes_id == Clothes.id)\
+            .join(User, User.id == Reserve.user_id)\
+            .order_by(Reserve.id).all()
+        return clothes, users, reserves
+
+    def test_same_seed_generates_same_data(self):
+        """Data depends on the seed only."""
+        with self.app.app_context():
+            datagen.populate(300, 50, 100, seed=1)
+            first = self.rows()
+            datagen.clear()
+            datagen.populate(300, 50, 100, seed=1)
+
+            self.assertEqual(self.rows(), first)
+            datagen.clear()
+            datagen.populate(300, 50, 100, seed=2)
+            self.assertNotEqual(self.rows(), first)
+
+    def test_reservations_are_consistent(self):
+        """Exactly the reserved clothes have one reservation each."""
+        with self.app.app_context():
+            names = ('clothes', 'users')
+            versions = [TableVersion.get(name) for name in names]
+            dataset = datagen.populate(500, 40, 200, chunk_size=64)
+
+            self.assertEqual(len(dataset.clothes_ids), 500)
+            self.assertEqual(len(dataset.user_ids), 40)
+            reserved = sorted(
+                clothes.id for clothes in
+                Clothes.query.filter(Clothes.status == 'reserved'))
+            self.assertEqual(reserved, dataset.reserved_ids)
+            self.assertEqual(
+                sorted(r.clothes_id for r in Reserve.query), reserved)
+            members = {user.id for user in User.query.filter_by(role='user')}
+            self.assertTrue(all(r.user_id in members for r in Reserve.query))
+            self.assertEqual(
+                [TableVersion.get(name) for name in names],
+                [version + 1 for version in versions])
+
+    def test_inserted_rows_keep_their_ids(self):
+        """Each row is returned with its own id, after existing rows."""
+        with self.app.app_context():
+            datagen.populate(10, 5, 0, seed=1)
+            rows = list(datagen.generate_users(random.Random(0), 7, 'ids'))
+            ids = datagen.insert_rows(User.__table__, rows, chunk_size=3)
+
+            self.assertEqual(
+                [User.query.get(user_id).auth0_id for user_id in ids],
+                [row['auth0_id'] for row in rows])
+
+    def test_too_many_reservations(self):
+        """Reservations cannot outnumber clothes."""
+        with self.app.app_context():
+            with self.assertRaises(ValueError):
+                datagen.populate(10, 5, 11)
+
+
+class ASGITestCase(unittest.TestCase):
+    """This class represents the ASGI entry point test case"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        @self.app.route('/echo', methods=['POST'])
+        def echo():
+            return jsonify({
+                'body': request.get_json(),
+                'args': request.args.to_dict(),
+                'header': request.headers.get('X-Test')
+            })
+
+        @self.app.route('/stream')
+        def stream():
+            return Response(
+                (chunk for chunk in (b'a', b'', b'b', b'c')),
+                mimetype='text/plain')
+
+        @self.app.route('/first-line', methods=['POST'])
+        def first_line():
+            line = request.stream.readline()
+            return jsonify({
+                'line': line.decode('utf-8'),
+                'pending': len(self.messages)
+            })
+
+        self.jwks_cache = JWKSCache('http://127.0.0.1:9/')
+        self.adapter = ASGIAdapter(self.app, 2, self.jwks_cache)
+        self.messages = []
+
+    def call(self, scope, messages):
+        """Returns: messages sent by the adapter"""
+        sent = []
+
+        self.messages = messages
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.adapter(scope, receive, send))
+        return sent
+
+    def request(self, method, path, query=b'', headers=(), body=b''):
+        scope = {
+            'type': 'http', 'method': method, 'path': path,
+            'query_string': query, 'headers': list(headers),
+            'http_version': '1.1', 'scheme': 'http'
+        }
+        # the body arrives in two parts
+        return self.call(scope, [
+            {'type': 'http.request', 'body': body[:5], 'more_body': True},
+            {'type': 'http.request', 'body': body[5:]}])
+
+    def test_requests_are_served(self):
+        """Method, path, query, headers and body reach the app."""
+        sent = self.request(
+            'POST', '/echo', b'a=1',
+            [(b'content-type', b'application/json'), (b'x-test', b'yes')],
+            b'{"clothes": [1, 2]}')
+
+        self.assertEqual(sent[0]['type'], 'http.response.start')
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn(
+            (b'content-type', b'application/json'), sent[0]['headers'])
+        body = b''.join(message['body'] for message in sent[1:])
+        self.assertEqual(json.loads(body), {
+            'body': {'clothes': [1, 2]}, 'args': {'a': '1'},
+            'header': 'yes'})
+        self.assertFalse(sent[-1].get('more_body', False))
+
+    def test_streamed_responses_stay_streamed(self):
+        """Each chunk of a streamed response is sent as it comes."""
+        sent = self.request('GET', '/stream')
+
+        self.assertEqual(
+            [message.get('body') for message in sent[1:]],
+            [b'a', b'b', b'c', b''])
+
+    def test_not_found(self):
+        """Errors of the app are passed on."""
+        sent = self.request('GET', '/missing')
+
+        self.assertEqual(sent[0]['status'], 404)
+
+    def test_failing_app(self):
+        """An app which fails before its response gets a 500."""
+        def failing_app(environ, start_response):
+            raise ValueError('failed')
+
+        self.adapter.wsgi_app = failing_app
+        sent = self.request('GET', '/')
+
+        self.assertEqual(sent[0]['status'], 500)
+        self.assertFalse(sent[-1].get('more_body', False))
+
+    def test_request_bodies_are_streamed(self):
+        """The body is received as the app reads it."""
+        scope = {
+            'type': 'http', 'method': 'POST', 'path': '/first-line',
+            'headers': [(b'transfer-encoding', b'chunked')]
+        }
+        sent = self.call(scope, [
+            {'type': 'http.request', 'body': b'{"a": 1}\n{"b"',
+             'more_body': True},
+            {'type': 'http.request', 'body': b': 2}\n', 'more_body': True},
+            {'type': 'http.request', 'body': b''}])
+
+        body = b''.join(message['body'] for message in sent[1:])
+        self.assertEqual(
+            json.loads(body), {'line': '{"a": 1}\n', 'pending': 2})
+
+    def test_lifespan_fetches_keys(self):
+        """Signing keys are fetched on startup, before any request."""
+        stub = JWKSStub().start()
+        self.jwks_cache.url = stub.url
+        try:
+            sent = self.call({'type': 'lifespan'}, [
+                {'type': 'lifespan.startup'},
+                {'type': 'lifespan.shutdown'}])
+        finally:
+            stub.stop()
+
+        self.assertEqual([message['type'] for message in sent], [
+            'lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertEqual(stub.fetches, 1)
+        self.assertIsNotNone(self.jwks_cache.get_key('benchmark'))
+        self.assertEqual(stub.fetches, 1)
+
+
+class ReadReplicaTestCase(unittest.TestCase):
+    """This class represents the read replica routing test case"""
+
+    def setUp(self):
+        # two databases which never replicate, so each read shows
+        # which of them has answered
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app()
+        self.app.secret_key = 'read replica test'
+        self.client = self.app.test_client
+        setup_db(
+            self.app,
+            'sqlite:///' + os.path.join(self.directory, 'primary.db'),
+            'sqlite:///' + os.path.join(self.directory, 'replica.db')
+            )
+        with self.app.app_context():
+            db.create_all()
+            self.primary = db.get_engine(self.app)
+            self.replica = db.get_engine(self.app, bind='replica')
+            db.Model.metadata.create_all(bind=self.replica)
+        self.add_clothes(self.primary, 'shirt')
+        self.add_clothes(self.replica, 'pants')
+        # responses cached by the other tests came from another database
+        response_cache.clear()
+        write_marks.clear()
+
+        self.user_headers = {
+            'Authorization': 'Bearer {}'.format(os.environ['USER_JWT'])
+        }
+        self.staff_headers = {
+            'Authorization': 'Bearer {}'.format(os.environ['STAFF_JWT'])
+        }
+
+    def tearDown(self):
+        self.primary.dispose()
+        self.replica.dispose()
+        shutil.rmtree(self.directory)
+
+    def add_clothes(self, engine, clothes_type):
+        engine.execute(
+            Clothes.__table__.insert(),
+            type=clothes_type,
+            size=100,
+            status='',
+            registered_time=datetime.utcnow()
+            )
+
+    def get_clothes_types(self, headers, client=None):
+        client = client or self.client()
+        res = client.get('/clothes', headers=headers)
+        return [item['type'] for item in json.loads(res.data)['clothes']]
+
+    def test_reads_go_to_replica(self):
+        """GET /clothes is answered by the read replica."""
+        self.assertEqual(self.get_clothes_types(self.user_headers), ['pants'])
+
+    def test_writes_go_to_primary(self):
+        """Writes go to the primary, and the writer reads them back."""
+        self.app.config['DB_REPLICA_LAG'] = 60
+        client = self.client()
+        res = client.post(
+            '/clothes',
+            json={'type': 'shoes', 'size': 20},
+            headers=self.staff_headers
+            )
+        self.assertEqual(res.status_code, 200)
+
+        # the client which has written reads from the primary
+        self.assertEqual(
+            self.get_clothes_types(self.staff_headers, client),
+            ['shirt', 'shoes'])
+        # other clients still read from the replica
+        self.assertEqual(self.get_clothes_types(self.user_headers), ['pants'])
+
+    def test_clients_without_cookies_read_their_writes(self):
+        """Clients which do not send cookies back, like cross-origin
+        ones, are known by the subject of their token."""
+        self.app.config['DB_REPLICA_LAG'] = 60
+        client = self.app.test_client(use_cookies=False)
+        res = client.post(
+            '/clothes',
+            json={'type': 'shoes', 'size': 20},
+            headers=self.staff_headers
+            )
+        self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(
+            self.get_clothes_types(self.staff_headers, client),
+            ['shirt', 'shoes'])
+        self.assertEqual(
+            self.get_clothes_types(self.user_headers, client), ['pants'])
+        self.app.config['DB_REPLICA_LAG'] = -1
+        self.assertEqual(
+            self.get_clothes_types(self.staff_headers, client), ['pants'])
+
+    def test_write_marker_is_shared_by_processes(self):
+        """The write marker is all another process needs to send the
+        reads of the writer to the primary, and it cannot be reused by
+        other clients, forged or kept beyond the lag."""
+        self.app.config['DB_REPLICA_LAG'] = 60
+        res = self.client().post(
+            '/clothes',
+            json={'type': 'shoes', 'size': 20},
+            headers=self.staff_headers
+            )
+        marker = res.headers['Set-Cookie'].split(';')[0]
+        # another process does not know the write marks of this one
+        write_marks.clear()
+
+        def read_with(cookie, headers):
+            # as a client of another process, without a cookie jar
+            return self.get_clothes_types(
+                dict(headers, Cookie=cookie),
+                self.app.test_client(use_cookies=False))
+        self.assertEqual(
+            read_with(marker, self.staff_headers), ['shirt', 'shoes'])
+        self.assertEqual(read_with(marker, self.user_headers), ['pants'])
+        # the low bits of the last character of the signature are
+        # padding, so a character in its middle is changed instead
+        name, signed = marker.split('=', 1)
+        forged = signed[:-10] + ('A' if signed[-10] != 'A' else 'B')\
+            + signed[-9:]
+        self.assertEqual(read_with(
+            '{}={}'.format(name, forged), self.staff_headers), ['pants'])
+        self.app.config['DB_REPLICA_LAG'] = -1
+        self.assertEqual(read_with(marker, self.staff_headers), ['pants'])
+
+    def test_replica_needs_secret_key(self):
+        """Write markers cannot be signed without a SECRET_KEY."""
+        app = Flask(__name__)
+        with self.assertRaises(RuntimeError):
+            setup_db(app, 'sqlite://', 'sqlite://')
+
+    def test_session_which_has_written_reads_primary(self):
+        """Reads after a flush see the flushed changes."""
+        with self.app.app_context():
+            with read_only():
+                self.assertEqual(Clothes.query.count(), 1)
+                shoes = Clothes(type='shoes', size=20)
+                shoes.registered_time = datetime.utcnow()
+                db.session.add(shoes)
+                db.session.flush()
+                self.assertEqual(Clothes.query.count(), 2)
+            db.session.rollback()
+
+
+class SerializerTestCase(unittest.TestCase):
+    """This class represents the json serializer test case"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.data = {
+            'success': True,
+            'total': 2,
+            'clothes': [{
+                'id': 1,
+                'type': 'shirt',
+                'size': 100.5,
+                'registerd': datetime(2020, 11, 3, 9, 5, 7, 123456),
+                'status': None
+            }, {
+                'id': 2,
+                'type': 'ワンピース "long"',
+                'size': 0.1,
+                'registerd': datetime(2021, 2, 28, 23, 59, 59),
+                'status': 'reserved'
+            }]
+        }
+
+    def test_encoders_match_jsonify(self):
+        """Every encoder writes the same bytes as jsonify."""
+        with self.app.app_context():
+            expected = jsonify(self.data).get_data()
+        for encoder in ENCODERS:
+            self.assertEqual(dumps(self.data, encoder) + b'\n', expected)
+
+    def test_encoders_match_jsonify_on_edge_values(self):
+        """Floats written with an exponent or not finite, and text which
+        is not ASCII, are written the same as jsonify does."""
+        values = [
+            1e16, 1e-7, 1e-5, 1e300, -0.0, float('nan'), float('inf'),
+            float('-inf'), 'caf\u00e9', '\U0001f455', '\x7f',
+            '\x00\b\f\n\t"\\/', '\u2028', 2 ** 70]
+        for value in values:
+            for data in [
+                    {'clothes': [{'size': value, 'type': 'shirt'}]},
+                    # rows which have been checked when formatted
+                    {'clothes': clothes_serializer.format_all(
+                        [(1, 'shirt', value, None, '')])}]:
+                with self.app.app_context():
+                    expected = jsonify(data).get_data()
+                for encoder in ENCODERS:
+                    self.assertEqual(
+                        dumps(data, encoder) + b'\n', expected,
+                        (encoder, value))
+
+    def test_pretty_printed_in_debug(self):
+        """Responses are indented in debug mode, as jsonify does."""
+        self.app.debug = True
+        with self.app.test_request_context():
+            self.assertEqual(
+                json_response(self.data).get_data(),
+                jsonify(self.data).get_data())
+            self.assertIn(b'\n  ', json_response(self.data).get_data())
+
+    def test_http_date_matches_flask(self):
+        """Timestamps are formatted the same as Flask's encoder does."""
+        value = datetime(2020, 1, 6, 0, 0, 1)
+        with self.app.app_context():
+            expected = json.loads(jsonify(value).get_data())
+        self.assertEqual(http_date(value), expected)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class represents the response cache test case"""
+
+    def setUp(self):
+        self.args = {'type': 'shirt'}
+
+    def key(self, version=1, args=None, permissions=('get:clothes',)):
+        return ResponseCache.key(
+            'clothes',
+            version,
+            'retrieve_clothes',
+            MultiDict(self.args if args is None else args),
+            permissions)
+
+    def test_key_covers_request(self):
+        """Versions, query strings and permissions are cached apart."""
+        self.assertEqual(self.key(), self.key())
+        self.assertNotEqual(self.key(), self.key(version=2))
+        self.assertNotEqual(self.key(), self.key(args={'type': 'pants'}))
+        self.assertNotEqual(
+            self.key(), self.key(permissions=('get:clothes', 'get:users')))
+
+    def test_invalidated_table_is_dropped(self):
+        """Invalidating a table drops only its responses."""
+        cache = ResponseCache(LocalBackend(maxsize=10), ttl=60)
+        cache.put(self.key(), b'clothes', 'application/json')
+        cache.put('users:1:digest', b'users', 'application/json')
+        cache.invalidate('clothes')
+
+        self.assertIsNone(cache.get(self.key()))
+        self.assertIsNotNone(cache.get('users:1:digest'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_least_recently_used_response_is_evicted(self):
+        """The local backend keeps the most recently used responses."""
+        cache = ResponseCache(LocalBackend(maxsize=2), ttl=60)
+        cache.put('clothes:1:a', b'a', 'application/json')
+        cache.put('clothes:1:b', b'b', 'application/json')
+        cache.get('clothes:1:a')
+        cache.put('clothes:1:c', b'c', 'application/json')
+
+        self.assertIsNone(cache.get('clothes:1:b'))
+        self.assertIsNotNone(cache.get('clothes:1:a'))
+
+    def test_shared_backend_needs_only_get_and_set(self):
+        """A backend without invalidate still serves fresh responses."""
+        class DictBackend(CacheBackend):
+            def __init__(self):
+                self.entries = {}
+
+            def get(self, key):
+                return self.entries.get(key)
+
+            def set(self, key, value, ttl):
+                self.entries[key] = value
+
+        cache = ResponseCache(DictBackend(), ttl=60)
+        cache.put(self.key(), b'clothes', 'application/json')
+        cache.invalidate('clothes')
+
+        self.assertEqual(
+            cache.get(self.key()), (b'clothes', 'application/json'))
+        self.assertIsNone(cache.get(self.key(version=2)))
+
+    def test_incomplete_backend_cannot_be_created(self):
+        """A backend has to implement get and set."""
+        class GetOnlyBackend(CacheBackend):
+            def get(self, key):
+                return None
+
+        with self.assertRaises(TypeError):
+            GetOnlyBackend()
+
+
+class CompressionTestCase(unittest.TestCase):
+    """This class represents the response compression test case"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.after_request(compress_response)
+        self.items = [{'id': i, 'type': 'shirt'} for i in range(200)]
+
+        @self.app.route('/large')
+        def large():
+            response = jsonify({'items': self.items})
+            response.set_etag('clothes-1')
+            return response
+
+        @self.app.route('/small')
+        def small():
+            return jsonify({'success': True})
+
+        @self.app.route('/stream')
+        def stream():
+            return Response(
+                (b'{}' for _ in range(1)), mimetype='application/json')
+
+        self.client = self.app.test_client
+
+    def test_gzip_is_negotiated(self):
+        """Large json is gzipped for clients which accept it."""
+        res = self.client().get(
+            '/large', headers={'Accept-Encoding': 'gzip, deflate'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(res.headers['ETag'], 'W/"clothes-1"')
+        self.assertLess(len(res.data), COMPRESSION_MIN_SIZE)
+        self.assertEqual(
+            json.loads(gzip.decompress(res.data))['items'], self.items)
+
+    @unittest.skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_brotli_is_preferred(self):
+        """Brotli is chosen when the client accepts it as well as gzip."""
+        res = self.client().get(
+            '/large', headers={'Accept-Encoding': 'gzip, br'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        self.assertEqual(
+            json.loads(compression.brotli.decompress(res.data))['items'],
+            self.items)
+
+    def test_uncompressed_responses(self):
+        """Small, streamed or not accepted responses are sent as they are."""
+        cases = [
+            ('/large', {}),
+            ('/large', {'Accept-Encoding': 'gzip;q=0'}),
+            ('/small', {'Accept-Encoding': 'gzip'}),
+            ('/stream', {'Accept-Encoding': 'gzip'})
+        ]
+        for path, headers in cases:
+            res = self.client().get(path, headers=headers)
+
+            self.assertNotIn('Content-Encoding', res.headers)
+            json.loads(res.data)
+
+
+class QueryBudgetTestCase(unittest.TestCase):
+    """This class represents the query budget test case"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.before_request(start_request)
+        engine = create_engine('sqlite://')
+
+        @self.app.route('/')
+        @query_budget(1)
+        def two_queries():
+            engine.execute('SELECT 1')
+            engine.execute('SELECT 2')
+            return 'done'
+
+        self.client = self.app.test_client
+
+    def test_queries_are_counted(self):
+        """count_queries counts the statements of the block."""
+        with count_queries() as queries:
+            self.client().get('/')
+
+        self.assertEqual(queries.count, 2)
+
+    def test_over_budget(self):
+        """Going over budget is ignored, logged or raised."""
+        labels = ('GET', '/')
+        self.app.config['QUERY_BUDGET'] = 'off'
+        exceeded = query_budget_exceeded._values.get(labels, 0)
+        self.assertEqual(self.client().get('/').status_code, 200)
+        # counted even when it is ignored
+        self.assertEqual(
+            query_budget_exceeded._values.get(labels), exceeded + 1)
+
+        self.app.config['QUERY_BUDGET'] = 'log'
+        with self.assertLogs(self.app.logger, 'WARNING'):
+            self.assertEqual(self.client().get('/').status_code, 200)
+
+        self.app.config['QUERY_BUDGET'] = 'raise'
+        self.assertEqual(self.client().get('/').status_code, 500)
+        self.app.config['PROPAGATE_EXCEPTIONS'] = True
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client().get('/')
+
+
+class EngineOptionsTestCase(unittest.TestCase):
+    """This class represents the connection pool settings test case"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.database_path = 'postgresql://localhost/closet'
+
+    def test_pool_settings_from_app_config(self):
+        """Pool settings are read from the app config."""
+        self.app.config['DB_POOL_SIZE'] = 20
+        self.app.config['DB_POOL_PRE_PING'] = False
+        self.app.config['DB_STATEMENT_TIMEOUT'] = '5000'
+        options = get_engine_options(self.app, self.database_path)
+
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 10)
+        self.assertEqual(options['pool_pre_ping'], False)
+        self.assertEqual(
+            options['connect_args']['options'],
+            '-c statement_timeout=5000')
+
+    def test_pgbouncer_mode(self):
+        """PgBouncer mode keeps no pool and sets no startup options."""
+        self.app.config['DB_PGBOUNCER'] = 'true'
+        self.app.config['DB_STATEMENT_TIMEOUT'] = 5000
+        options = get_engine_options(self.app, self.database_path)
+
+        self.assertEqual(options['poolclass'], NullPool)
+        self.assertEqual(options['transaction_statement_timeout'], 5000)
+        self.assertNotIn('connect_args', options)
+
+    def test_flags_accept_numbers(self):
+        """Flags may be given as numbers as well as strings."""
+        self.app.config['DB_PGBOUNCER'] = 1
+        self.app.config['DB_POOL_PRE_PING'] = 0
+
+        self.assertEqual(
+            get_engine_options(self.app, self.database_path)['poolclass'],
+            NullPool)
+        self.app.config['DB_PGBOUNCER'] = 0
+        options = get_engine_options(self.app, self.database_path)
+        self.assertEqual(options['pool_pre_ping'], False)
+
+    def test_replica_settings(self):
+        """The replica has pool settings of its own, which default to
+        those of the primary."""
+        self.app.config['DB_POOL_SIZE'] = 20
+        self.app.config['DB_STATEMENT_TIMEOUT'] = 5000
+        self.app.config['DB_REPLICA_POOL_SIZE'] = 40
+        options = get_engine_options(
+            self.app, self.database_path, 'replica')
+
+        self.assertEqual(options['pool_size'], 40)
+        self.assertEqual(
+            options['connect_args']['options'],
+            '-c statement_timeout=5000')
+        self.assertEqual(
+            get_engine_options(self.app, self.database_path)['pool_size'],
+            20)
+
+    def test_other_databases_keep_defaults(self):
+        """Pool settings are only applied to PostgreSQL."""
+        self.app.config['DB_POOL_SIZE'] = 20
+
+        self.assertEqual(get_engine_options(self.app, 'sqlite://'), {})
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS cache test case"""
+
+    def setUp(self):
+        """Define a cache which counts its fetches instead of using network."""
+        self.fetches = []
+        self.keys = {'keys': [public_jwk('key1')]}
+        self.cache = JWKSCache('https://example.com/.well-known/jwks.json')
+
+        def fetch():
+            self.fetches.append(time.monotonic())
+            return self.keys
+        self.cache.fetch = fetch
+
+    def test_keys_are_fetched_once(self):
+        """Known kid is served from the cache after the first fetch."""
+        key = self.cache.get_key('key1')
+        for _ in range(10):
+            self.assertIs(self.cache.get_key('key1'), key)
+
+        self.assertEqual(len(self.fetches), 1)
+
+    def test_keys_are_parsed_on_load(self):
+        """Cached keys are public key objects, unusable keys are skipped."""
+        self.keys['keys'].append({'kid': 'broken', 'kty': 'RSA'})
+        key = self.cache.get_key('key1')
+
+        self.assertTrue(hasattr(key, 'verify'))
+        self.assertIsNone(self.cache.get_key('broken'))
+
+    def test_unknown_kid_refetches_rate_limited(self):
+        """Unknown kid refetches once, then waits for the interval."""
+        self.cache.min_refresh_interval = 0
+        self.cache.get_key('key1')
+        self.keys['keys'].append(public_jwk('key2'))
+
+        self.assertIsNotNone(self.cache.get_key('key2'))
+        self.assertEqual(len(self.fetches), 2)
+
+        self.cache.min_refresh_interval = 60
+        self.assertIsNone(self.cache.get_key('key3'))
+        self.assertIsNone(self.cache.get_key('key3'))
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_expired_keys_refresh_in_background(self):
+        """Stale keys are still served while being refreshed."""
+        self.cache.ttl = 0
+        self.cache.get_key('key1')
+        time.sleep(0.01)
+
+        self.assertIsNotNone(self.cache.get_key('key1'))
+        for _ in range(100):
+            if len(self.fetches) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(self.fetches), 2)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        self.cache = TokenCache(maxsize=2)
+        self.payload = {'sub': 'auth0|test', 'exp': time.time() + 60}
+
+    def test_verified_token_is_returned(self):
+        """Payload of a verified token is returned for the same token."""
+        self.cache.put('token', self.payload)
+
+        self.assertEqual(self.cache.get('token'), self.payload)
+        self.assertIsNone(self.cache.get('other token'))
+
+    def test_expired_token_is_dropped(self):
+        """Payload is not returned once the token has expired."""
+        self.cache.put('token', {'sub': 'auth0|test', 'exp': time.time()})
+
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_least_recently_used_token_is_evicted(self):
+        """Cache does not grow beyond maxsize."""
+        self.cache.put('token1', self.payload)
+        self.cache.put('token2', self.payload)
+        self.cache.get('token1')
+        self.cache.put('token3', self.payload)
+
+        self.assertIsNotNone(self.cache.get('token1'))
+        self.assertIsNone(self.cache.get('token2'))
+        self.assertIsNotNone(self.cache.get('token3'))
+
+
+class AccessUserCacheTestCase(unittest.TestCase):
+    """This class represents the accessing user cache test case"""
+
+    def setUp(self):
+        self.cache = AccessUserCache(maxsize=2, ttl=60)
+        self.access_user = AccessUser(1, 'user')
+
+    def test_invalidated_user_is_dropped(self):
+        """Invalidated auth0_id is resolved again."""
+        self.cache.put('auth0|test', self.access_user)
+        self.assertEqual(self.cache.get('auth0|test'), self.access_user)
+
+        self.cache.invalidate('auth0|test')
+        self.assertIsNone(self.cache.get('auth0|test'))
+
+    def test_expired_user_is_dropped(self):
+        """Cached user is not trusted after ttl."""
+        self.cache.ttl = 0
+        self.cache.put('auth0|test', self.access_user)
+
+        self.assertIsNone(self.cache.get('auth0|test'))
+
+
+class LoadBenchmarkTestCase(unittest.TestCase):
+    """This class represents the load benchmark test case"""
+
+    def test_stub_serves_keys_of_its_tokens(self):
+        """Tokens minted by the stub verify with the key set it serves."""
+        stub = JWKSStub().start()
+        try:
+            token = stub.mint('benchmark|user-0', 'staff')
+            jwks = JWKSCache(stub.url).fetch()
+        finally:
+            stub.stop()
+        payload = jwt.decode(
+            token, jwks, algorithms=['RS256'], audience=stub.audience,
+            issuer='https://{}/'.format(stub.domain))
+
+        self.assertEqual(stub.fetches, 1)
+        self.assertEqual(payload['sub'], 'benchmark|user-0')
+        self.assertIn('get:users', payload['permissions'])
+
+    def test_percentile(self):
+        """Percentiles are taken by nearest rank."""
+        values = [i / 100 for i in range(1, 101)]
+
+        self.assertEqual(percentile(values, 50), 0.5)
+        self.assertEqual(percentile(values, 99), 0.99)
+        self.assertEqual(percentile([0.3], 95), 0.3)
+        self.assertEqual(percentile([], 95), 0.0)
+
+    def test_compare(self):
+        """Only changes beyond the tolerance are regressions."""
+        baseline = {
+            'GET /clothes': {'throughput': 100.0, 'p95': 10.0, 'errors': 0},
+            'GET /users': {'throughput': 100.0, 'p95': 10.0, 'errors': 0}
+        }
+        results = {
+            'GET /clothes': {'throughput': 90.0, 'p95': 11.0, 'errors': 0},
+            'GET /users': {'throughput': 70.0, 'p95': 13.0, 'errors': 2},
+            'POST /users': {'throughput': 10.0, 'p95': 50.0, 'errors': 0}
+        }
+        regressions = compare(baseline, results, 0.2)
+
+        self.assertEqual(len(regressions), 3)
+        self.assertTrue(all(
+            message.startswith('GET /users:') for message in regressions))
+
 
 # Make the tests conveniently excecutabe
 if __name__ == "__main__":
@@ -0,0 +1,275 @@
+import asyncio
+import io
+import json
+import os
+import ssl
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from app import app
+from auth import jwks_cache
+
+# threads which run requests, as many as the connections the database
+# pool opens by default; the other requests in flight wait on the event
+# loop without holding a thread
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 15))
+# seconds to wait for the key set of the identity provider
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 10))
+
+
+async def fetch_jwks(url, timeout=JWKS_FETCH_TIMEOUT):
+    """Download the key set without blocking the event loop.
+
+    Returns: parsed key set
+
+    Note: OSError or asyncio.TimeoutError will be raised if the key set
+          cannot be downloaded.
+    """
+    parts = urlsplit(url)
+    https = parts.scheme == 'https'
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(
+        parts.hostname,
+        parts.port or (443 if https else 80),
+        ssl=ssl.create_default_context() if https else None), timeout)
+    try:
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        writer.write(
+            'GET {} HTTP/1.0\r\nHost: {}\r\nAccept: application/json\r\n\r\n'
+            .format(path or '/', parts.netloc).encode('ascii'))
+        # HTTP/1.0 responses end when the connection is closed
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    status_line = head.split(b'\r\n', 1)[0].decode('latin-1')
+    if status_line.split(' ')[1:2] != ['200']:
+        raise OSError('{} answered {}'.format(url, status_line))
+    return json.loads(body)
+
+
+class RequestBody(io.RawIOBase):
+    """wsgi.input of an ASGI request. The thread which runs the request
+    receives the body from the event loop part by part as the app reads
+    it, so large bodies are never held in memory at once. A client which
+    disconnects ends the body early.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def _receive_part(self):
+        message = asyncio.run_coroutine_threadsafe(
+            self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect':
+            self._more = False
+            return
+        self._buffer.extend(message.get('body', b''))
+        self._more = message.get('more_body', False)
+
+    def _take(self, size):
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        while self._more and (size is None or size < 0
+                              or len(self._buffer) < size):
+            self._receive_part()
+        if size is None or size < 0:
+            size = len(self._buffer)
+        return self._take(size)
+
+    def readline(self, size=-1):
+        while self._more and b'\n' not in self._buffer and (
+                size is None or size < 0 or len(self._buffer) < size):
+            self._receive_part()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        return self._take(end)
+
+
+def build_environ(scope, body):
+    """Returns: WSGI environ of an ASGI http request whose body is read
+    from the file-like body"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8')
+        .decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # the body ends by itself, also when it comes in chunks without
+        # a Content-Length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = name
+        else:
+            key = 'HTTP_' + name
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+
+# ASGI Adapter
+# Serve the app from an event loop, for servers like uvicorn
+class ASGIAdapter:
+    """ASGI application which serves a WSGI app.
+
+    The event loop accepts connections, and each request runs in a
+    thread of a bounded pool, so one process holds many requests in
+    flight while only ASGI_THREADS of them use the database at a time.
+    Request bodies are received as the app reads them, and response
+    bodies are sent chunk by chunk as the app produces them, so streamed
+    requests and responses stay streamed.
+
+    On startup the signing keys are downloaded by the event loop, and
+    they are refreshed by it before they become stale, so requests
+    never wait for the identity provider.
+    """
+
+    def __init__(self, wsgi_app, threads=ASGI_THREADS, jwks_cache=jwks_cache):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='asgi')
+        self.jwks_cache = jwks_cache
+        self._refresher = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle(scope, receive, send)
+        else:
+            raise ValueError('unsupported scope: ' + scope['type'])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                refreshed = await self.refresh_keys()
+                self._refresher = asyncio.ensure_future(
+                    self.keep_keys(refreshed))
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._refresher is not None:
+                    self._refresher.cancel()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def refresh_keys(self):
+        """Replace the cached signing keys with downloaded ones.
+
+        Returns: True if the keys have been refreshed
+        """
+        try:
+            jwks = await fetch_jwks(self.jwks_cache.url)
+        except Exception:
+            # requests fetch the keys themselves, as they do under WSGI
+            print(sys.exc_info())
+            return False
+        self.jwks_cache.refresh(jwks)
+        return True
+
+    async def keep_keys(self, refreshed):
+        """Refresh the signing keys at half their ttl, or after the
+        minimum refresh interval once a refresh has failed."""
+        while True:
+            await asyncio.sleep(max(1, (
+                self.jwks_cache.ttl / 2 if refreshed
+                else self.jwks_cache.min_refresh_interval)))
+            refreshed = await self.refresh_keys()
+
+    async def handle(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        environ = build_environ(scope, RequestBody(receive, loop))
+        await loop.run_in_executor(
+            self.executor, self.run_wsgi, environ, loop, send)
+
+    def run_wsgi(self, environ, loop, send):
+        """Run the WSGI app in the current thread and send its response
+        through the event loop. An app which fails before its response
+        has begun is answered with 500 Internal Server Error."""
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['start'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [
+                    (name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers]
+            }
+            return write
+
+        def write(data):
+            if not response.get('sent'):
+                send_message(response['start'])
+                response['sent'] = True
+            send_message({
+                'type': 'http.response.body',
+                'body': data,
+                'more_body': True
+            })
+
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            try:
+                for data in iterable:
+                    if data:
+                        write(data)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+            if 'start' not in response:
+                raise RuntimeError('start_response has not been called')
+        except Exception:
+            # a response which has begun cannot be taken back
+            if response.get('sent'):
+                raise
+            print(sys.exc_info())
+            response['start'] = {
+                'type': 'http.response.start',
+                'status': 500,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8')]
+            }
+            response['body'] = b'Internal Server Error'
+        if not response.get('sent'):
+            send_message(response['start'])
+        send_message({
+            'type': 'http.response.body',
+            'body': response.get('body', b'')
+        })
+
+
+application = ASGIAdapter(app)
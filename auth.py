@@ -1,14 +1,39 @@
+import hashlib
 import json
 import os
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from itertools import chain
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
+from jose import jwk, jwt
+from jose.utils import base64url_decode
+from sqlalchemy import event, inspect
 from urllib.request import urlopen
+from models import db, RoutingSession, User
+from metrics import timed
 
 
 AUTH_DOMAIN = os.environ['AUTH_DOMAIN']
 ALGORITHMS = os.environ['ALGORITHMS']
 API_AUDIENCE = os.environ['API_AUDIENCE']
+# where the signing keys are downloaded from, the identity provider's
+# key set unless a local one is served, as the benchmarks do
+JWKS_URL = os.environ.get(
+    'JWKS_URL', 'https://{}/.well-known/jwks.json'.format(AUTH_DOMAIN))
+# seconds before cached signing keys are refreshed in the background
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+# minimum seconds between refetches caused by an unknown kid
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+# number of verified tokens kept in memory
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+# seconds a resolved accessing user is trusted by the other workers
+ACCESS_USER_CACHE_TTL = int(os.environ.get('ACCESS_USER_CACHE_TTL', 60))
+# number of resolved accessing users kept in memory
+ACCESS_USER_CACHE_SIZE = int(os.environ.get('ACCESS_USER_CACHE_SIZE', 1024))
 
 
 # AuthError Exception
@@ -19,6 +44,246 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS Cache
+# Keep the signing keys of our identity provider in memory
+class JWKSCache:
+    """In-process cache of the JSON Web Key Set, indexed by kid.
+
+    Each key is parsed into a public key object once, when the key set
+    is loaded, so verification does not rebuild it per request.
+    Keys older than ttl are still served while a background thread
+    refreshes them. A kid which is not in the cache triggers one
+    synchronous refetch so that key rotation is picked up immediately,
+    but such refetches happen at most once per min_refresh_interval.
+    """
+
+    def __init__(self, url, ttl=JWKS_CACHE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refreshing = False
+        self._fetch_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+
+    def fetch(self):
+        """Download the key set."""
+        jsonurl = urlopen(self.url)
+        return json.loads(jsonurl.read())
+
+    @staticmethod
+    def load(jwks):
+        """Construct public key objects and index them by kid.
+
+        Keys which cannot be used for verification are skipped.
+        """
+        keys = {}
+        for key in jwks['keys']:
+            if 'kid' not in key:
+                continue
+            try:
+                keys[key['kid']] = jwk.construct(
+                    key, key.get('alg', ALGORITHMS))
+            except Exception:
+                continue
+        return keys
+
+    def refresh(self, jwks=None):
+        """Replace the cached keys with the given key set, or else with a
+        freshly fetched one.
+        """
+        self._last_attempt = time.monotonic()
+        keys = self.load(self.fetch() if jwks is None else jwks)
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+
+    def get_key(self, kid):
+        """Look up the signing key of the given kid.
+
+        Returns: public key object or None if the identity provider
+                 does not know the kid either.
+        """
+        if self._fetched_at is None:
+            # nothing cached yet, every request has to wait for the keys
+            with self._fetch_lock:
+                if self._fetched_at is None:
+                    self.refresh()
+        elif time.monotonic() - self._fetched_at > self.ttl:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch():
+            with self._fetch_lock:
+                if self._may_refetch():
+                    self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    def clear(self):
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+
+    def _may_refetch(self):
+        return (self._last_attempt is None or
+                time.monotonic() - self._last_attempt >=
+                self.min_refresh_interval)
+
+    def _refresh_in_background(self):
+        with self._state_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._background_refresh)
+        thread.daemon = True
+        thread.start()
+
+    def _background_refresh(self):
+        try:
+            with self._fetch_lock:
+                self.refresh()
+        except Exception:
+            # keep serving the stale keys, retry after the next request
+            print(sys.exc_info())
+        finally:
+            self._refreshing = False
+
+
+jwks_cache = JWKSCache(JWKS_URL)
+
+
+# Token Cache
+# Skip signature verification for tokens we have already verified
+class TokenCache:
+    """Bounded LRU of verified JWT payloads.
+
+    Entries are keyed by a SHA-256 digest of the token, so the raw
+    bearer tokens are never kept in memory, and are dropped as soon as
+    the token reaches its exp claim.
+    """
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        """Returns: cached payload, or None for unknown or expired tokens"""
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            payload, exp = entry
+            if exp <= time.time():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return payload
+
+    def put(self, token, payload):
+        """Store a verified payload. Tokens without exp are never cached."""
+        exp = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return
+        digest = self._digest(token)
+        with self._lock:
+            self._entries[digest] = (payload, exp)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache()
+
+
+# Access User Cache
+# Resolve auth0_id to the user who is accessing without a query
+AccessUser = namedtuple('AccessUser', ['id', 'role'])
+
+
+class AccessUserCache:
+    """Bounded LRU of AccessUser records keyed by auth0_id.
+
+    Users changed or deleted through the models of this process are
+    invalidated once the change is committed. The ttl bounds how long
+    any other change stays unseen: those made by other workers, by bulk
+    statements like datagen.clear(), or directly in the database.
+    """
+
+    def __init__(self, maxsize=ACCESS_USER_CACHE_SIZE,
+                 ttl=ACCESS_USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, auth0_id):
+        """Returns: cached AccessUser or None"""
+        with self._lock:
+            entry = self._entries.get(auth0_id)
+            if entry is None:
+                return None
+            access_user, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[auth0_id]
+                return None
+            self._entries.move_to_end(auth0_id)
+            return access_user
+
+    def put(self, auth0_id, access_user):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[auth0_id] = (
+                access_user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(auth0_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, auth0_id):
+        with self._lock:
+            self._entries.pop(auth0_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+access_user_cache = AccessUserCache()
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def collect_changed_users(session, flush_context, instances):
+    changed = session.info.setdefault('changed_users', set())
+    for obj in chain(session.dirty, session.deleted):
+        if isinstance(obj, User):
+            # both the old and the new auth0_id if it has been changed
+            changed.update(inspect(obj).attrs.auth0_id.history.sum())
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def invalidate_changed_users(session):
+    for auth0_id in session.info.pop('changed_users', ()):
+        access_user_cache.invalidate(auth0_id)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_changed_users(session):
+    session.info.pop('changed_users', None)
+
+
 # Auth Header
 def get_token_auth_header():
     """Fetch the token from HTTP request header.
@@ -91,33 +356,35 @@ def verify_decode_jwt(token):
     Note: AuthError will be raised if the token is malformed, expired,
           or compromised.
     """
-    jsonurl = urlopen('https://{}/.well-known/jwks.json'.format(AUTH_DOMAIN))
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed'
         }, 401)
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+    with timed('jwks'):
+        rsa_key = jwks_cache.get_key(unverified_header['kid'])
+    if rsa_key is not None:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://{}/'.format(AUTH_DOMAIN)
-            )
+            with timed('jwt'):
+                # verify the signature with the pre-parsed key object, then
+                # let python-jose check the claims of the verified token
+                if unverified_header.get('alg') not in ALGORITHMS:
+                    raise jwt.JWTError(
+                        'The specified alg value is not allowed')
+                signing_input, crypto_segment = token.encode('utf-8')\
+                    .rsplit(b'.', 1)
+                signature = base64url_decode(crypto_segment)
+                if not rsa_key.verify(signing_input, signature):
+                    raise jwt.JWTError('Signature verification failed.')
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=ALGORITHMS,
+                    audience=API_AUDIENCE,
+                    issuer='https://{}/'.format(AUTH_DOMAIN),
+                    options={'verify_signature': False}
+                )
 
             return payload
 
@@ -146,15 +413,54 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+def get_access_user():
+    """Resolve the user who is accessing from the verified JWT payload.
+    The user is looked up at most once per request, and across requests
+    through access_user_cache.
+
+    Returns: AccessUser with id and role of the accessing user
+
+    Note: AuthError will be raised if no user is registered with the
+          sub of the JWT payload.
+    """
+    ctx = _request_ctx_stack.top
+    access_user = getattr(ctx, 'access_user', None)
+    if access_user is not None:
+        return access_user
+
+    auth0_id = ctx.current_user['sub']
+    access_user = access_user_cache.get(auth0_id)
+    if access_user is None:
+        row = db.session.query(User.id, User.role)\
+            .filter_by(auth0_id=auth0_id).first()
+        if row is None:
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'User not registered'
+            }, 401)
+        access_user = AccessUser(row.id, row.role)
+        access_user_cache.put(auth0_id, access_user)
+
+    ctx.access_user = access_user
+    return access_user
+
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            # Authentication
-            payload = verify_decode_jwt(token)
-            # Authorization
-            check_permissions(permission, payload)
+            with timed('auth'):
+                token = get_token_auth_header()
+                # Authentication
+                payload = token_cache.get(token)
+                if payload is None:
+                    payload = verify_decode_jwt(token)
+                    token_cache.put(token, payload)
+                # Authorization
+                check_permissions(permission, payload)
+            _request_ctx_stack.top.current_user = payload
+            # lets the client read its own writes from the primary
+            db.session.info['client'] = payload.get('sub')
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,61 @@
+"""Benchmark of response compression on GET /clothes payloads.
+
+Usage: python -m benchmarks.compression [--sizes 10,100,1000,10000]
+
+Prints the time each encoding and level takes to compress a catalog of
+each size, and how many bytes are left to send.
+"""
+import argparse
+import json
+import random
+import timeit
+from compression import COMPRESSORS
+
+LEVELS = {'gzip': (1, 6, 9), 'br': (1, 5, 11)}
+TYPES = ('shirt', 'pants', 'dress', 'jacket', 'skirt', 'shoes')
+
+
+def make_catalog(size, seed=0):
+    """Returns: GET /clothes body of the given number of clothes"""
+    rng = random.Random(seed)
+    clothes = [{
+        'id': i + 1,
+        'type': rng.choice(TYPES),
+        'size': float(rng.randrange(50, 160, 10)),
+        'registerd': 'Fri, 18 Dec 2020 %02d:%02d:%02d GMT' % (
+            rng.randrange(24), rng.randrange(60), rng.randrange(60)),
+        'status': rng.choice(('', '', 'reserved'))
+    } for i in range(size)]
+    body = {'success': True, 'total': size, 'clothes': clothes}
+    return json.dumps(
+        body, sort_keys=True, separators=(',', ':')).encode('ascii')
+
+
+def measure(compress, data, level):
+    """Returns: tuple of seconds per compression and compressed bytes"""
+    timer = timeit.Timer(lambda: compress(data, level))
+    number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat=3, number=number)) / number
+    return seconds, len(compress(data, level))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='10,100,1000,10000')
+    args = parser.parse_args()
+
+    print('{:>8} {:>10} {:>8} {:>6} {:>10} {:>7} {:>9}'.format(
+        'clothes', 'bytes', 'encoding', 'level', 'compressed', 'ratio',
+        'ms'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        data = make_catalog(size)
+        for encoding, compress in COMPRESSORS.items():
+            for level in LEVELS[encoding]:
+                seconds, compressed = measure(compress, data, level)
+                print('{:>8} {:>10} {:>8} {:>6} {:>10} {:>7.3f} {:>9.3f}'
+                      .format(size, len(data), encoding, level, compressed,
+                              compressed / len(data), seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Local identity provider for offline benchmarks.
+
+Serves a JSON Web Key Set over HTTP on localhost and mints RS256 access
+tokens signed by its key, so the app can verify them the same way it
+verifies the tokens of Auth0 once JWKS_URL points to the stub.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import rsa
+from jose import jwk, jwt
+
+KID = 'benchmark'
+
+# permissions of each role, as they are configured in Auth0
+PERMISSIONS = {
+    'user': [
+        'get:clothes', 'get:reservations', 'post:reservations',
+        'delete:reservations'],
+    'staff': [
+        'get:clothes', 'post:clothes', 'patch:clothes', 'delete:clothes',
+        'get:reservations', 'delete:reservations', 'get:users'],
+    'manager': [
+        'get:clothes', 'post:clothes', 'patch:clothes', 'delete:clothes',
+        'get:reservations', 'delete:reservations', 'get:users',
+        'post:users', 'patch:users', 'delete:users', 'get:metrics'],
+}
+
+
+class JWKSStub:
+    """Key set served from a background thread.
+
+    domain and audience have to match AUTH_DOMAIN and API_AUDIENCE of
+    the app, which reads them when auth is imported.
+    """
+
+    def __init__(self, domain='closet.benchmark', audience='closet',
+                 host='127.0.0.1', port=0):
+        self.domain = domain
+        self.audience = audience
+        _, private_key = rsa.newkeys(2048)
+        self.private_pem = private_key.save_pkcs1().decode('ascii')
+        public_key = jwk.construct(self.private_pem, 'RS256').public_key()
+        key = public_key.to_dict()
+        key.update({'kid': KID, 'use': 'sig', 'alg': 'RS256'})
+        self.jwks = json.dumps({'keys': [key]}).encode('ascii')
+        self.fetches = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/.well-known/jwks.json':
+                    self.send_error(404)
+                    return
+                stub.fetches += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(stub.jwks)))
+                self.end_headers()
+                self.wfile.write(stub.jwks)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    @property
+    def url(self):
+        """Returns: URL of the key set, the value of JWKS_URL"""
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/.well-known/jwks.json'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def mint(self, sub, role='user', ttl=3600):
+        """Returns: access token of the subject with the role's permissions
+        """
+        now = int(time.time())
+        claims = {
+            'iss': 'https://{}/'.format(self.domain),
+            'sub': sub,
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + ttl,
+            'permissions': PERMISSIONS[role]
+        }
+        return jwt.encode(
+            claims, self.private_pem, algorithm='RS256',
+            headers={'kid': KID})
@@ -0,0 +1,488 @@
+"""Load test of every endpoint, without Auth0.
+
+Usage: python -m benchmarks.load [--database sqlite:///benchmark.db]
+           [--clothes 5000] [--users 500] [--reservations 1000] [--seed 0]
+           [--concurrency 8] [--iterations 25]
+           [--output FILE] [--compare FILE] [--tolerance 0.2]
+
+A JWKSStub signs the tokens and serves its key set to the app, the
+database is emptied and seeded, and the app is served on localhost by
+this process. Each scenario then runs its requests from concurrent
+clients. Throughput and p50/p95/p99 latency of each endpoint are
+printed and written to --output as JSON. With --compare, an endpoint
+which has lost more than --tolerance of the throughput or p95 latency
+of a baseline written before fails the run.
+
+Note: The database is dropped and created again; never point --database
+      at data which has to be kept.
+"""
+import argparse
+import gzip
+import http.client
+import json
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+from datetime import datetime
+from werkzeug.serving import WSGIRequestHandler, make_server
+from benchmarks.jwks_stub import JWKSStub
+
+TYPES = ('shirt', 'pants', 'dress', 'jacket', 'skirt', 'shoes')
+PERCENTILES = (50, 95, 99)
+
+
+# Environment
+# The app reads its settings when it is imported, so set them first
+def configure(stub, database):
+    """Point the app at the stub and the database, then import it.
+
+    Returns: the Flask app
+    """
+    os.environ['AUTH_DOMAIN'] = stub.domain
+    os.environ['API_AUDIENCE'] = stub.audience
+    os.environ['ALGORITHMS'] = 'RS256'
+    os.environ['JWKS_URL'] = stub.url
+    os.environ['DATABASE_URL'] = database
+    os.environ.pop('DATABASE_REPLICA_URL', None)
+    from app import app
+    return app
+
+
+class Context:
+    """Accounts and ids the scenarios work with."""
+
+    def __init__(self, stub, concurrency):
+        self.concurrency = concurrency
+        self.user_subs = [
+            'benchmark|user-{}'.format(worker)
+            for worker in range(concurrency)]
+        self.user_tokens = [stub.mint(sub) for sub in self.user_subs]
+        self.staff_token = stub.mint('benchmark|staff', 'staff')
+        self.manager_token = stub.mint('benchmark|manager', 'manager')
+        # filled by seed()
+        self.user_ids = []
+        self.clothes_ids = []
+        self.reserved_ids = []
+        # available clothes of each worker, which only it reserves
+        self.pools = []
+
+
+def seed(ctx, clothes, users, reservations, seed=0):
+    """Empty the database and fill it with the accounts of the benchmark
+    and a synthetic dataset of the given volumes.
+    """
+    import datagen
+    from models import db, commit, touch, User
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    accounts = [(sub, 'user') for sub in ctx.user_subs] + [
+        ('benchmark|staff', 'staff'), ('benchmark|manager', 'manager')]
+    db.session.execute(User.__table__.insert(), [{
+        'e_mail': '{}@benchmark.local'.format(sub.split('|')[1]),
+        'address': 'Shibuya-ku, Tokyo',
+        'auth0_id': sub,
+        'role': role
+    } for sub, role in accounts])
+    touch(User.__tablename__)
+    commit()
+    ids = dict(db.session.query(User.auth0_id, User.id))
+    ctx.user_ids = [ids[sub] for sub in ctx.user_subs]
+
+    dataset = datagen.populate(clothes, users, reservations, seed)
+    db.session.remove()
+
+    reserved = set(dataset.reserved_ids)
+    available = [clothes_id for clothes_id in dataset.clothes_ids
+                 if clothes_id not in reserved]
+    ctx.clothes_ids = dataset.clothes_ids
+    ctx.reserved_ids = dataset.reserved_ids or dataset.clothes_ids
+    ctx.pools = [available[worker::ctx.concurrency]
+                 for worker in range(ctx.concurrency)]
+
+
+# Server
+# Serve the app on localhost, keeping connections alive like gunicorn
+class KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # headers and body are written separately, which Nagle's
+        # algorithm would delay until the client acknowledges them
+        self.connection.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve(app):
+    """Returns: started server, stopped by shutdown()"""
+    server = make_server(
+        '127.0.0.1', 0, app, threaded=True,
+        request_handler=KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Client
+# One connection per worker, timing each request under its endpoint
+class Client:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.connection = http.client.HTTPConnection(host, port)
+        # endpoint: list of seconds
+        self.latencies = {}
+        # endpoint: number of failed requests
+        self.errors = {}
+        self.recording = True
+
+    def request(self, endpoint, method, path, token, body=None):
+        """Returns: parsed json body of the response, or None"""
+        headers = {
+            'Authorization': 'Bearer ' + token,
+            'Accept-Encoding': 'gzip'
+        }
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        started_at = time.perf_counter()
+        try:
+            self.connection.request(method, path, data, headers)
+            response = self.connection.getresponse()
+            payload = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = http.client.HTTPConnection(
+                self.host, self.port)
+            self.record(endpoint, None)
+            return None
+        self.record(endpoint, time.perf_counter() - started_at,
+                    response.status < 400)
+
+        if response.getheader('Content-Encoding') == 'gzip':
+            payload = gzip.decompress(payload)
+        try:
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def record(self, endpoint, seconds, ok=False):
+        if not self.recording:
+            return
+        if seconds is not None:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def close(self):
+        self.connection.close()
+
+
+# Scenarios
+# Each is called with a client, the context, the worker and the iteration
+def list_clothes(client, ctx, worker, i):
+    client.request('GET /clothes', 'GET', '/clothes',
+                   ctx.user_tokens[worker])
+
+
+def page_clothes(client, ctx, worker, i):
+    from app import encode_cursor
+    start = ctx.clothes_ids[(worker * 7919 + i * 104729)
+                            % len(ctx.clothes_ids)]
+    client.request(
+        'GET /clothes?limit=50', 'GET',
+        '/clothes?limit=50&cursor={}'.format(encode_cursor(start)),
+        ctx.user_tokens[worker])
+
+
+def filter_clothes(client, ctx, worker, i):
+    client.request(
+        'GET /clothes?type&status', 'GET',
+        '/clothes?type={}&status=available&limit=50'.format(
+            TYPES[(worker + i) % len(TYPES)]),
+        ctx.user_tokens[worker])
+
+
+def list_clothes_reservations(client, ctx, worker, i):
+    clothes_id = ctx.reserved_ids[(worker + i * ctx.concurrency)
+                                  % len(ctx.reserved_ids)]
+    client.request(
+        'GET /clothes/<id>/reservations', 'GET',
+        '/clothes/{}/reservations'.format(clothes_id), ctx.staff_token)
+
+
+def list_users(client, ctx, worker, i):
+    client.request('GET /users', 'GET', '/users', ctx.staff_token)
+
+
+def list_user_reservations(client, ctx, worker, i):
+    client.request(
+        'GET /users/<id>/reservations', 'GET',
+        '/users/{}/reservations'.format(ctx.user_ids[worker]),
+        ctx.user_tokens[worker])
+
+
+def reserve_and_cancel(client, ctx, worker, i):
+    pool = ctx.pools[worker]
+    if not pool:
+        return
+    clothes_id = pool[i % len(pool)]
+    path = '/clothes/{}/reservations'.format(clothes_id)
+    body = {'auth0_id': ctx.user_subs[worker]}
+    client.request('POST /clothes/<id>/reservations', 'POST', path,
+                   ctx.user_tokens[worker], body)
+    client.request('DELETE /clothes/<id>/reservations', 'DELETE', path,
+                   ctx.user_tokens[worker])
+
+
+def reserve_many_and_cancel_all(client, ctx, worker, i):
+    pool = ctx.pools[worker]
+    if not pool:
+        return
+    start = i * 3 % len(pool)
+    clothes_ids = sorted(set((pool + pool)[start:start + 3]))
+    path = '/users/{}/reservations'.format(ctx.user_ids[worker])
+    body = {
+        'auth0_id': ctx.user_subs[worker],
+        'reservations': clothes_ids
+    }
+    client.request('POST /users/<id>/reservations', 'POST', path,
+                   ctx.user_tokens[worker], body)
+    client.request('DELETE /users/<id>/reservations', 'DELETE', path,
+                   ctx.user_tokens[worker])
+
+
+def manage_clothes(client, ctx, worker, i):
+    created = client.request(
+        'POST /clothes', 'POST', '/clothes', ctx.staff_token,
+        {'type': TYPES[i % len(TYPES)], 'size': 100.0})
+    if not created or 'clothes' not in created:
+        return
+    path = '/clothes/{}'.format(created['clothes']['id'])
+    client.request('PATCH /clothes/<id>', 'PATCH', path, ctx.staff_token,
+                   {'size': 110.0})
+    client.request('DELETE /clothes/<id>', 'DELETE', path, ctx.staff_token)
+
+
+def manage_users(client, ctx, worker, i):
+    sub = 'benchmark|temporary-{}-{}-{}'.format(worker, i, time.time_ns())
+    created = client.request(
+        'POST /users', 'POST', '/users', ctx.manager_token, {
+            'e_mail': '{}@benchmark.local'.format(sub.split('|')[1]),
+            'address': 'Shibuya-ku, Tokyo',
+            'auth0_id': sub,
+            'role': 'user'
+        })
+    if not created or 'user' not in created:
+        return
+    path = '/users/{}'.format(created['user']['id'])
+    client.request('PATCH /users/<id>', 'PATCH', path, ctx.manager_token,
+                   {'address': 'Minato-ku, Tokyo'})
+    client.request('DELETE /users/<id>', 'DELETE', path, ctx.manager_token)
+
+
+def create_clothes_in_bulk(client, ctx, worker, i):
+    client.request(
+        'POST /clothes/bulk', 'POST', '/clothes/bulk', ctx.staff_token,
+        [{'type': TYPES[n % len(TYPES)], 'size': 100.0}
+         for n in range(100)])
+
+
+SCENARIOS = {
+    'list_clothes': list_clothes,
+    'page_clothes': page_clothes,
+    'filter_clothes': filter_clothes,
+    'list_clothes_reservations': list_clothes_reservations,
+    'list_users': list_users,
+    'list_user_reservations': list_user_reservations,
+    'reserve_and_cancel': reserve_and_cancel,
+    'reserve_many_and_cancel_all': reserve_many_and_cancel_all,
+    'manage_clothes': manage_clothes,
+    'manage_users': manage_users,
+    'create_clothes_in_bulk': create_clothes_in_bulk,
+}
+
+
+def run_scenario(scenario, ctx, host, port, iterations, warmup=1):
+    """Run the scenario from one client per worker at the same time.
+
+    Returns: tuple of the clients and the seconds the run has taken
+    """
+    clients = [Client(host, port) for _ in range(ctx.concurrency)]
+    barrier = threading.Barrier(ctx.concurrency + 1)
+
+    def work(worker):
+        client = clients[worker]
+        client.recording = False
+        for i in range(warmup):
+            scenario(client, ctx, worker, iterations + i)
+        client.recording = True
+        barrier.wait()
+        for i in range(iterations):
+            scenario(client, ctx, worker, i)
+
+    threads = [threading.Thread(target=work, args=(worker,))
+               for worker in range(ctx.concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started_at
+    for client in clients:
+        client.close()
+    return clients, seconds
+
+
+# Report
+def percentile(values, p):
+    """Returns: nearest-rank percentile of the values"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(clients, seconds):
+    """Returns: dict of endpoint: statistics of its requests"""
+    latencies, errors = {}, {}
+    for client in clients:
+        for endpoint, values in client.latencies.items():
+            latencies.setdefault(endpoint, []).extend(values)
+        for endpoint, count in client.errors.items():
+            errors[endpoint] = errors.get(endpoint, 0) + count
+
+    results = {}
+    for endpoint in sorted(set(latencies) | set(errors)):
+        values = latencies.get(endpoint, [])
+        result = {
+            'requests': len(values),
+            'errors': errors.get(endpoint, 0),
+            'throughput': round(len(values) / seconds, 2)
+        }
+        for p in PERCENTILES:
+            result['p{}'.format(p)] = round(percentile(values, p) * 1000, 3)
+        results[endpoint] = result
+    return results
+
+
+def print_results(results):
+    print('{:<36} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms'))
+    for endpoint, result in results.items():
+        print('{:<36} {:>8} {:>6} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f}'
+              .format(endpoint, result['requests'], result['errors'],
+                      result['throughput'], result['p50'], result['p95'],
+                      result['p99']))
+
+
+def compare(baseline, results, tolerance):
+    """Compare results with the ones of a baseline run.
+
+    Returns: list of messages about endpoints which have regressed
+    """
+    regressions = []
+    for endpoint, result in results.items():
+        base = baseline.get(endpoint)
+        if base is None:
+            continue
+        if base['throughput'] and \
+                result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append('{}: throughput {:.1f} req/s, was {:.1f}'
+                               .format(endpoint, result['throughput'],
+                                       base['throughput']))
+        if base['p95'] and result['p95'] > base['p95'] * (1 + tolerance):
+            regressions.append('{}: p95 {:.2f} ms, was {:.2f}'.format(
+                endpoint, result['p95'], base['p95']))
+        if result['errors'] > base['errors']:
+            regressions.append('{}: {} errors, was {}'.format(
+                endpoint, result['errors'], base['errors']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database', default='sqlite:///benchmark.db')
+    parser.add_argument('--clothes', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--reservations', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--iterations', type=int, default=25,
+                        help='iterations of each scenario per client')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline results to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    stub = JWKSStub().start()
+    app = configure(stub, args.database)
+    ctx = Context(stub, args.concurrency)
+    with app.app_context():
+        seed(ctx, args.clothes, args.users, args.reservations, args.seed)
+    server = serve(app)
+
+    results = {}
+    try:
+        for name in args.scenarios.split(','):
+            clients, seconds = run_scenario(
+                SCENARIOS[name], ctx, '127.0.0.1', server.server_port,
+                args.iterations)
+            results.update(summarize(clients, seconds))
+    finally:
+        server.shutdown()
+        stub.stop()
+    print_results(results)
+
+    report = {
+        'meta': {
+            'created': datetime.utcnow().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'database': args.database.split(':')[0],
+            'clothes': args.clothes,
+            'users': args.users,
+            'reservations': args.reservations,
+            'seed': args.seed,
+            'concurrency': args.concurrency,
+            'iterations': args.iterations
+        },
+        'endpoints': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for key in ('database', 'clothes', 'users', 'reservations',
+                    'seed', 'concurrency', 'iterations'):
+            if baseline['meta'].get(key) != report['meta'][key]:
+                print('warning: {} differs from the baseline ({} != {})'
+                      .format(key, report['meta'][key],
+                              baseline['meta'].get(key)))
+        regressions = compare(
+            baseline['endpoints'], results, args.tolerance)
+        for message in regressions:
+            print('regression: ' + message)
+        if regressions:
+            sys.exit(1)
+        print('no regressions beyond {:.0%}'.format(args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Throughput of the sync and the ASGI serving paths at high concurrency.
+
+Usage: python -m benchmarks.serving [--servers gunicorn,uvicorn]
+           [--workers 1] [--threads 15] [--concurrency 64] [--iterations 10]
+           [--database sqlite:///benchmark.db] [--output FILE]
+
+The database is seeded like benchmarks.load does, then each server is
+started in its own process: gunicorn with gthread workers serving
+app:app, and uvicorn serving asgi:application. Both run the requests in
+the same number of threads per worker, ASGI_THREADS unless --threads is
+given, so they differ only in how connections wait for a thread. The
+same scenarios are run against both from one client per concurrent
+connection, and throughput and latency of each endpoint are printed
+side by side. uvicorn is optional and is skipped if it is not
+installed.
+
+Note: The database is dropped and created again; never point --database
+      at data which has to be kept.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+from benchmarks.jwks_stub import JWKSStub
+from benchmarks.load import SCENARIOS, Context, configure, seed
+from benchmarks.load import run_scenario, summarize, print_results
+
+HOST = '127.0.0.1'
+
+
+def gunicorn_command(port, workers, threads):
+    # gunicorn 20.0 cannot be run by python -m
+    return [sys.executable, '-c',
+            'from gunicorn.app.wsgiapp import run; run()',
+            '--bind', '{}:{}'.format(HOST, port),
+            '--workers', str(workers),
+            '--worker-class', 'gthread',
+            '--threads', str(threads),
+            '--log-level', 'warning',
+            'app:app']
+
+
+def uvicorn_command(port, workers, threads):
+    # asgi.py reads its number of threads from ASGI_THREADS
+    return [sys.executable, '-m', 'uvicorn',
+            '--host', HOST,
+            '--port', str(port),
+            '--workers', str(workers),
+            '--log-level', 'warning',
+            '--no-access-log',
+            'asgi:application']
+
+
+SERVERS = {'gunicorn': gunicorn_command, 'uvicorn': uvicorn_command}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def start_server(name, command, port, timeout=30):
+    """Start the server next to the app and wait until it accepts
+    connections.
+
+    Returns: server process
+    """
+    directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(command, cwd=directory)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('{} has exited'.format(name))
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('{} has not started'.format(name))
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def print_comparison(results):
+    servers = list(results)
+    endpoints = sorted(set().union(*(results[s] for s in servers)))
+    print('{:<36}'.format('req/s') + ''.join(
+        ' {:>12}'.format(server) for server in servers))
+    for endpoint in endpoints:
+        print('{:<36}'.format(endpoint) + ''.join(
+            ' {:>12.1f}'.format(
+                results[server].get(endpoint, {}).get('throughput', 0.0))
+            for server in servers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database', default='sqlite:///benchmark.db')
+    parser.add_argument('--clothes', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--reservations', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--servers', default=','.join(SERVERS))
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes of each server')
+    parser.add_argument('--threads', type=int,
+                        default=int(os.environ.get('ASGI_THREADS', 15)),
+                        help='request threads of each worker')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--iterations', type=int, default=10,
+                        help='iterations of each scenario per client')
+    parser.add_argument(
+        '--scenarios',
+        default='page_clothes,list_clothes_reservations,'
+                'list_user_reservations,reserve_and_cancel')
+    parser.add_argument('--output', help='write the results to this file')
+    args = parser.parse_args()
+
+    stub = JWKSStub().start()
+    app = configure(stub, args.database)
+    ctx = Context(stub, args.concurrency)
+    with app.app_context():
+        seed(ctx, args.clothes, args.users, args.reservations, args.seed)
+
+    os.environ['ASGI_THREADS'] = str(args.threads)
+    results = {}
+    try:
+        for server in args.servers.split(','):
+            if importlib.util.find_spec(server) is None:
+                print('{} is not installed, skipped'.format(server))
+                continue
+            port = free_port()
+            command = SERVERS[server](port, args.workers, args.threads)
+            process = start_server(server, command, port)
+            endpoints = {}
+            try:
+                for name in args.scenarios.split(','):
+                    clients, seconds = run_scenario(
+                        SCENARIOS[name], ctx, HOST, port, args.iterations)
+                    endpoints.update(summarize(clients, seconds))
+            finally:
+                stop_server(process)
+            print(server)
+            print_results(endpoints)
+            print()
+            results[server] = endpoints
+    finally:
+        stub.stop()
+    if results:
+        print_comparison(results)
+
+    if args.output:
+        report = {
+            'meta': {
+                'created': datetime.utcnow().isoformat(timespec='seconds'),
+                'database': args.database.split(':')[0],
+                'clothes': args.clothes,
+                'users': args.users,
+                'reservations': args.reservations,
+                'seed': args.seed,
+                'workers': args.workers,
+                'threads': args.threads,
+                'concurrency': args.concurrency,
+                'iterations': args.iterations
+            },
+            'servers': results
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
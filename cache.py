@@ -0,0 +1,235 @@
+import hashlib
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from flask import Response, request, _request_ctx_stack
+from functools import wraps
+from sqlalchemy import event
+from models import RoutingSession, TableVersion
+from metrics import registry, CallbackCounter
+
+
+# number of responses kept in memory, 0 disables the cache
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+# seconds a cached response is served at most
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+# number of clients whose last write each process remembers
+WRITE_MARKS_SIZE = int(os.environ.get('WRITE_MARKS_SIZE', 4096))
+
+
+def table_version(table):
+    """Returns: version of the table, read once per request"""
+    ctx = _request_ctx_stack.top
+    versions = getattr(ctx, 'table_versions', None)
+    if versions is None:
+        versions = ctx.table_versions = {}
+    if table not in versions:
+        versions[table] = TableVersion.get(table)
+    return versions[table]
+
+
+# Cache Backends
+# Where cached responses are stored
+class CacheBackend(ABC):
+    """Interface of response cache backends.
+
+    Keys start with the name of the table the response was read from,
+    followed by its version, so a write makes the old entries
+    unreachable by itself. Backends shared by several processes, such
+    as memcached or Redis, only need get and set; invalidate merely
+    frees the entries early.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """Returns: cached value, or None"""
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        """Store a value for ttl seconds."""
+
+    def invalidate(self, prefix):
+        """Drop the entries whose key starts with the prefix."""
+
+    def clear(self):
+        """Drop all entries."""
+
+
+class LocalBackend(CacheBackend):
+    """Bounded in-process LRU, the default backend."""
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, prefix):
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Response Cache
+# Serve repeated reads of unchanged tables from memory
+class ResponseCache:
+    """Cache of serialized GET responses.
+
+    A response is keyed by the table it was read from and that table's
+    version, the endpoint, the query string and the permissions of the
+    requester. Commits which change a table invalidate its entries.
+    """
+
+    def __init__(self, backend=None, ttl=RESPONSE_CACHE_TTL):
+        self.backend = backend or LocalBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(table, version, endpoint, args, permissions):
+        """Returns: cache key of a response"""
+        digest = hashlib.sha256(repr((
+            endpoint,
+            sorted(args.items(multi=True)),
+            sorted(permissions)
+            )).encode('utf-8')).hexdigest()
+        return '{}:{}:{}'.format(table, version, digest)
+
+    def get(self, key):
+        """Returns: cached (body, mimetype), or None"""
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key, body, mimetype):
+        self.backend.set(key, (body, mimetype), self.ttl)
+
+    def invalidate(self, table):
+        """Drop the responses read from the table."""
+        self.backend.invalidate(table + ':')
+
+    def stats(self):
+        """Returns: dict of hit and miss counts"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+response_cache = ResponseCache()
+registry.register(CallbackCounter(
+    'closet_response_cache_hits_total',
+    'Responses served from the response cache.',
+    lambda: response_cache.stats()['hits']))
+registry.register(CallbackCounter(
+    'closet_response_cache_misses_total',
+    'Responses which were not found in the response cache.',
+    lambda: response_cache.stats()['misses']))
+
+
+# Write Marks
+# Remember which clients have just written
+class WriteMarks:
+    """Time of the last committed write of each client, keyed by the
+    subject of its access token, so the reads of a client which has
+    just written go to the primary whether or not it sends cookies
+    back. With a backend shared by all server processes, whichever
+    process answers knows of the write.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or LocalBackend(WRITE_MARKS_SIZE)
+
+    @staticmethod
+    def key(client):
+        return 'wrote:' + client
+
+    def mark(self, client, lag):
+        """Remember that the client has written now."""
+        # wall clock time, which every process of the backend shares
+        self.backend.set(self.key(client), time.time(), max(lag, 0) + 1)
+
+    def wrote_within(self, client, lag):
+        """Returns: True if the client has written within lag seconds"""
+        written_at = self.backend.get(self.key(client))
+        return written_at is not None and time.time() - written_at < lag
+
+    def clear(self):
+        self.backend.clear()
+
+
+write_marks = WriteMarks()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def invalidate_committed_tables(session):
+    for table in session.info.pop('bumped_tables', ()):
+        response_cache.invalidate(table)
+
+
+def cached(table):
+    """Decorator of GET handlers which answer with the rows of a table.
+    Responses are served from the response cache while the table is
+    unchanged; streamed responses are never cached. The X-Cache header
+    tells whether the response has been served from the cache.
+    """
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            key = response_cache.key(
+                table,
+                table_version(table),
+                request.endpoint,
+                request.args,
+                payload.get('permissions', []))
+            value = response_cache.get(key)
+            if value is not None:
+                body, mimetype = value
+                response = Response(body, mimetype=mimetype)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            response = f(payload, *args, **kwargs)
+            if response.status_code == 200 and not response.is_streamed:
+                response_cache.put(key, response.get_data(), response.mimetype)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+
+        return wrapper
+    return cached_decorator
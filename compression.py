@@ -0,0 +1,84 @@
+import gzip
+import os
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# responses smaller than this many bytes are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+# gzip level between 1 (fastest) and 9 (smallest)
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 6))
+# brotli quality between 0 (fastest) and 11 (smallest)
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+# mimetypes worth compressing
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/html', 'text/plain')
+
+
+def compress_gzip(data, level=None):
+    """Returns: data compressed by gzip"""
+    # a fixed mtime keeps the output the same for the same data
+    return gzip.compress(
+        data,
+        compresslevel=COMPRESSION_LEVEL if level is None else level,
+        mtime=0)
+
+
+def compress_brotli(data, level=None):
+    """Returns: data compressed by brotli"""
+    return brotli.compress(
+        data,
+        mode=brotli.MODE_TEXT,
+        quality=BROTLI_QUALITY if level is None else level)
+
+
+# supported encodings, most preferred first
+COMPRESSORS = {'gzip': compress_gzip}
+if brotli is not None:
+    COMPRESSORS = {'br': compress_brotli, 'gzip': compress_gzip}
+
+
+def choose_encoding(accept_encodings):
+    """Returns: the supported encoding the client accepts with the highest
+                quality, preferring brotli on a tie, or None
+    """
+    best, best_quality = None, 0
+    for encoding in COMPRESSORS:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress_response(response):
+    """after_request hook which compresses the response body with the
+    encoding negotiated through Accept-Encoding.
+    Streamed, small, already encoded and non-text responses are sent as
+    they are. The ETag of a compressed response is made weak, because
+    the body differs from the uncompressed one byte for byte.
+
+    Returns: the response
+    """
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.is_streamed or response.direct_passthrough \
+            or response.status_code < 200 \
+            or response.status_code in (204, 206, 304) \
+            or 'Content-Encoding' in response.headers:
+        return response
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return response
+
+    response.set_data(COMPRESSORS[encoding](data))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,146 @@
+import random
+from bisect import bisect
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import accumulate, islice
+from models import db, commit, next_ids, touch, Clothes, User, Reserve
+
+# relative frequency of each type of clothes, most donations are shirts
+TYPE_WEIGHTS = (
+    ('shirt', 32), ('pants', 22), ('dress', 12), ('jacket', 10),
+    ('skirt', 8), ('sweater', 7), ('shoes', 5), ('coat', 3), ('hat', 1))
+# relative frequency of each size in cm, toddlers' sizes are the commonest
+SIZE_WEIGHTS = (
+    (50.0, 2), (60.0, 4), (70.0, 7), (80.0, 11), (90.0, 15), (100.0, 17),
+    (110.0, 15), (120.0, 11), (130.0, 8), (140.0, 5), (150.0, 3),
+    (160.0, 2))
+# share of staff and managers among the generated users
+ROLE_WEIGHTS = (('user', 980), ('staff', 18), ('manager', 2))
+# exponent of the Zipf distribution of reservations over users
+RESERVATION_SKEW = 1.1
+# clothes are registered over this period, starting at REGISTERED_SINCE
+REGISTERED_SINCE = datetime(2020, 1, 1)
+REGISTERED_DAYS = 730
+# rows sent to the database per statement
+CHUNK_SIZE = 5000
+
+Dataset = namedtuple('Dataset', ['clothes_ids', 'user_ids', 'reserved_ids'])
+
+
+def weighted(rng, weights):
+    """Returns: function which draws one of the values of weights"""
+    values = [value for value, _ in weights]
+    cum_weights = list(accumulate(weight for _, weight in weights))
+    total = cum_weights[-1]
+    return lambda: values[bisect(cum_weights, rng.random() * total)]
+
+
+def generate_clothes(rng, count, reserved):
+    """Generate rows of clothes in order of registered time.
+
+    reserved: set of the indexes of the rows which are reserved
+    """
+    draw_type = weighted(rng, TYPE_WEIGHTS)
+    draw_size = weighted(rng, SIZE_WEIGHTS)
+    seconds = REGISTERED_DAYS * 86400
+    for index in range(count):
+        yield {
+            'type': draw_type(),
+            'size': draw_size(),
+            'registered_time': REGISTERED_SINCE + timedelta(
+                seconds=int(seconds * index / count)),
+            'status': 'reserved' if index in reserved else ''
+        }
+
+
+def generate_users(rng, count, prefix):
+    draw_role = weighted(rng, ROLE_WEIGHTS)
+    for index in range(count):
+        name = '{}-{}'.format(prefix, index)
+        yield {
+            'e_mail': '{}@example.com'.format(name),
+            'address': '{}-{}-{} Shibuya-ku, Tokyo'.format(
+                rng.randint(1, 5), rng.randint(1, 30), rng.randint(1, 20)),
+            'auth0_id': 'datagen|{}'.format(name),
+            'role': draw_role()
+        }
+
+
+def insert_rows(table, rows, chunk_size=CHUNK_SIZE):
+    """insert rows in chunks. PostgreSQL inserts a chunk with one
+    multi-row INSERT of rows whose ids have been drawn beforehand, like
+    Clothes.insert_many does; other databases insert row by row, as
+    they report no ids of an executemany.
+
+    Returns: list of ids of the inserted rows, in the same order
+    """
+    postgresql = db.session.get_bind().dialect.name == 'postgresql'
+    ids = []
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        if postgresql:
+            for row, row_id in zip(chunk, next_ids(table, len(chunk))):
+                row['id'] = row_id
+            db.session.execute(table.insert().values(chunk))
+            ids.extend(row['id'] for row in chunk)
+        else:
+            for row in chunk:
+                result = db.session.execute(table.insert(), row)
+                ids.extend(result.inserted_primary_key)
+    return ids
+
+
+def clear():
+    """delete all reservations, clothes and users."""
+    for model in (Reserve, Clothes, User):
+        db.session.execute(model.__table__.delete())
+    touch(Clothes.__tablename__, User.__tablename__)
+    commit()
+
+
+def populate(clothes, users, reservations, seed=0, chunk_size=CHUNK_SIZE):
+    """Generate a synthetic dataset with bulk inserts in a single commit.
+    The same seed generates the same rows. Clothes types and sizes are
+    skewed like real donations, and a few users make most reservations.
+
+    Returns: Dataset of the ids of the generated clothes, users and
+             reserved clothes
+
+    Note: ValueError will be raised if there are more reservations than
+          clothes, or reservations but no users with the user role.
+    """
+    if reservations > clothes:
+        raise ValueError('more reservations than clothes')
+    rng = random.Random(seed)
+
+    user_rows = list(generate_users(rng, users, 'user-{}'.format(seed)))
+    if reservations and all(row['role'] != 'user' for row in user_rows):
+        raise ValueError('reservations need users with the user role')
+    user_ids = insert_rows(User.__table__, user_rows, chunk_size)
+    members = [user_id for user_id, row in zip(user_ids, user_rows)
+               if row['role'] == 'user']
+
+    reserved = sorted(rng.sample(range(clothes), reservations))
+    clothes_ids = insert_rows(
+        Clothes.__table__,
+        generate_clothes(rng, clothes, set(reserved)),
+        chunk_size)
+    reserved_ids = [clothes_ids[index] for index in reserved]
+
+    if reservations:
+        # the n-th most active user reserves in proportion to 1 / n^s
+        draw_user = weighted(rng, [
+            (user_id, 1 / rank ** RESERVATION_SKEW)
+            for rank, user_id in enumerate(members, 1)])
+        insert_rows(
+            Reserve.__table__,
+            ({'clothes_id': clothes_id, 'user_id': draw_user()}
+             for clothes_id in reserved_ids),
+            chunk_size)
+
+    touch(Clothes.__tablename__, User.__tablename__)
+    commit()
+    return Dataset(clothes_ids, user_ids, reserved_ids)
@@ -1,8 +1,10 @@
-from flask_script import Manager
+import time
+from flask_script import Manager, prompt_bool
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
 from models import db
+import datagen
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +12,35 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('--clothes', dest='clothes', type=int, default=100000,
+                help='number of clothes to generate')
+@manager.option('--users', dest='users', type=int, default=10000,
+                help='number of users to generate')
+@manager.option('--reservations', dest='reservations', type=int,
+                default=30000, help='number of clothes to reserve')
+@manager.option('--seed', dest='seed', type=int, default=0,
+                help='the same seed generates the same data')
+@manager.option('--reset', dest='reset', action='store_true',
+                help='delete all clothes, users and reservations first')
+@manager.option('--yes', dest='yes', action='store_true',
+                help='reset without asking for confirmation')
+def seed(clothes, users, reservations, seed, reset=False, yes=False):
+    """Bulk generate synthetic clothes, users and reservations."""
+    # the password of the database url is masked by its repr
+    if reset and not yes and not prompt_bool(
+            'Delete all clothes, users and reservations of {!r}'
+            .format(db.engine.url)):
+        print('aborted')
+        return
+    started_at = time.perf_counter()
+    if reset:
+        datagen.clear()
+    dataset = datagen.populate(clothes, users, reservations, seed)
+    print('generated {} clothes, {} users and {} reservations in {:.1f}s'
+          .format(len(dataset.clothes_ids), len(dataset.user_ids),
+                  len(dataset.reserved_ids),
+                  time.perf_counter() - started_at))
+
+
 if __name__ == '__main__':
     manager.run()
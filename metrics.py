@@ -0,0 +1,338 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, request, _request_ctx_stack
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# add a Server-Timing header with the phases of each request; off by
+# default, since it tells every client how the server spends its time
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'false').lower() in (
+    '1', 'true', 'yes', 'on')
+
+# what to do when a request issues more SQL statements than the budget
+# its handler has declared: 'off', 'log' or 'raise'
+QUERY_BUDGET = os.environ.get('QUERY_BUDGET', 'off')
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def format_labels(labelnames, labels):
+    if not labelnames:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(labelnames, labels)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Prometheus counter with labels."""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+    """Prometheus histogram with labels."""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # labels: [count of each bucket, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted(
+                (labels, (list(counts), total))
+                for labels, (counts, total) in self._values.items())
+        labelnames = self.labelnames + ('le',)
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       format_labels(labelnames, labels + (
+                           format_value(bound),)),
+                       cumulative)
+            text = format_labels(self.labelnames, labels)
+            yield self.name + '_count', text, cumulative
+            yield self.name + '_sum', text, total
+
+
+class CallbackCounter:
+    """Prometheus counter whose value is read from a function."""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, read):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def samples(self):
+        yield self.name, '', self.read()
+
+
+class Registry:
+    """Collection of metrics rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns: all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(
+                metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(
+                    name, labels, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+requests_total = registry.register(Counter(
+    'closet_requests_total',
+    'Requests by endpoint and status.',
+    ('method', 'endpoint', 'status')))
+request_duration = registry.register(Histogram(
+    'closet_request_duration_seconds',
+    'Time spent in the application per request.',
+    ('method', 'endpoint')))
+sql_statements = registry.register(Histogram(
+    'closet_sql_statements_per_request',
+    'SQL statements executed per request.',
+    ('method', 'endpoint'),
+    COUNT_BUCKETS))
+sql_duration = registry.register(Histogram(
+    'closet_sql_duration_seconds',
+    'Time spent executing SQL statements per request.',
+    ('method', 'endpoint')))
+phase_duration = registry.register(Histogram(
+    'closet_phase_duration_seconds',
+    'Time spent in a phase of a request, such as auth or jwks.',
+    ('phase',)))
+query_budget_exceeded = registry.register(Counter(
+    'closet_query_budget_exceeded_total',
+    'Requests which have issued more SQL statements than their budget.',
+    ('method', 'endpoint')))
+
+
+# Request Metrics
+# Measurements of the request being served
+class RequestMetrics:
+    """Timings of one request, kept on the request context."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.sql_count = 0
+        self.sql_duration = 0.0
+        # phase: seconds, in the order the phases have started
+        self.phases = {}
+
+
+def current_metrics():
+    """Returns: RequestMetrics of the request being served, or None"""
+    ctx = _request_ctx_stack.top
+    return getattr(ctx, 'metrics', None) if ctx is not None else None
+
+
+def start_request():
+    """before_request hook which starts measuring the request."""
+    _request_ctx_stack.top.metrics = RequestMetrics()
+
+
+@contextmanager
+def timed(phase):
+    """Measure the enclosed work as a phase of the current request."""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started_at
+        phase_duration.observe((phase,), seconds)
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.phases[phase] = metrics.phases.get(phase, 0.0) + seconds
+
+
+# Query Counters
+# Count the statements issued by any block of code, in or out of requests
+_local = threading.local()
+
+
+class QueryCounter:
+    """SQL statements issued while count_queries is active."""
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements the current thread issues in the block.
+    Counters can be nested.
+
+    Returns: QueryCounter, as the target of the with statement
+    """
+    counter = QueryCounter()
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = []
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    for counter in getattr(_local, 'counters', ()):
+        counter.statements.append(statement)
+    conn.info.setdefault('statement_started_at', []).append(
+        time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    started_at = conn.info['statement_started_at'].pop()
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.sql_count += 1
+        metrics.sql_duration += time.perf_counter() - started_at
+
+
+@event.listens_for(Engine, 'handle_error')
+def fail_statement(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('statement_started_at'):
+        conn.info['statement_started_at'].pop()
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(limit):
+    """Declare how many SQL statements a request of the decorated handler
+    may issue, counting the ones of authentication. Going over budget is
+    counted in query_budget_exceeded, and then ignored, logged or raised
+    as QueryBudgetExceeded, as the QUERY_BUDGET setting of the app
+    config or environment tells.
+
+    Note: The budget is checked when the handler returns, before the
+          request commits its unit of work, so a raised
+          QueryBudgetExceeded rolls back the writes of the request.
+    """
+    def query_budget_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            response = f(*args, **kwargs)
+            check_query_budget(limit)
+            return response
+
+        wrapper.query_budget = limit
+        return wrapper
+    return query_budget_decorator
+
+
+def check_query_budget(limit):
+    metrics = current_metrics()
+    if metrics is None or metrics.sql_count <= limit:
+        return
+    rule = request.url_rule
+    query_budget_exceeded.inc((request.method, rule.rule))
+    mode = current_app.config.get('QUERY_BUDGET', QUERY_BUDGET)
+    if mode == 'off':
+        return
+    message = '{} {} issued {} SQL statements, over its budget of {}'\
+        .format(request.method, request.path, metrics.sql_count, limit)
+    if mode == 'raise':
+        raise QueryBudgetExceeded(message)
+    current_app.logger.warning(message)
+
+
+def finish_request(response):
+    """Record the metrics of the current request, and describe them in
+    the Server-Timing header of its response. Streamed responses are
+    measured until their handler has returned.
+
+    Returns: the response
+    """
+    metrics = current_metrics()
+    if metrics is None:
+        return response
+    seconds = time.perf_counter() - metrics.started_at
+    rule = request.url_rule
+    labels = (request.method, rule.rule if rule is not None else 'unmatched')
+    requests_total.inc(labels + (str(response.status_code),))
+    request_duration.observe(labels, seconds)
+    sql_statements.observe(labels, metrics.sql_count)
+    sql_duration.observe(labels, metrics.sql_duration)
+
+    if current_app.config.get('SERVER_TIMING', SERVER_TIMING):
+        timings = ['{};dur={:.2f}'.format(phase, phase_seconds * 1000)
+                   for phase, phase_seconds in metrics.phases.items()]
+        timings.append('db;dur={:.2f};desc="{} queries"'.format(
+            metrics.sql_duration * 1000, metrics.sql_count))
+        timings.append('app;dur={:.2f}'.format(seconds * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
@@ -0,0 +1,34 @@
+"""add indexes for filtering clothes
+
+Revision ID: 319be230b709
+Revises: f4ffb016955c
+Create Date: 2026-10-18 10:12:41.305128
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '319be230b709'
+down_revision = 'f4ffb016955c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_clothes_type_size',
+        'clothes',
+        ['type', 'size'],
+        unique=False)
+    op.create_index(
+        'ix_clothes_status_registered_time',
+        'clothes',
+        ['status', 'registered_time'],
+        unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_clothes_status_registered_time', table_name='clothes')
+    op.drop_index('ix_clothes_type_size', table_name='clothes')
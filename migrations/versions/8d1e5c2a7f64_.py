@@ -0,0 +1,50 @@
+"""add indexes for reservations of users and available clothes
+
+Revision ID: 8d1e5c2a7f64
+Revises: 319be230b709
+Create Date: 2026-10-18 14:03:27.518904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d1e5c2a7f64'
+down_revision = '319be230b709'
+branch_labels = None
+depends_on = None
+
+available = sa.text("status IS NULL OR status != 'reserved'")
+
+
+def upgrade():
+    # CONCURRENTLY keeps the tables writable while the indexes are built
+    # on PostgreSQL, and it cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_reserves_user_id',
+            'reserves',
+            ['user_id'],
+            unique=False,
+            postgresql_concurrently=True)
+        op.create_index(
+            'ix_clothes_available',
+            'clothes',
+            ['id'],
+            unique=False,
+            postgresql_where=available,
+            sqlite_where=available,
+            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_clothes_available',
+            table_name='clothes',
+            postgresql_concurrently=True)
+        op.drop_index(
+            'ix_reserves_user_id',
+            table_name='reserves',
+            postgresql_concurrently=True)
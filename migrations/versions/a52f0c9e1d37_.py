@@ -0,0 +1,33 @@
+"""add table versions for conditional requests
+
+Revision ID: a52f0c9e1d37
+Revises: 8d1e5c2a7f64
+Create Date: 2026-10-18 16:41:09.207315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a52f0c9e1d37'
+down_revision = '8d1e5c2a7f64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [
+        {'name': 'clothes', 'version': 0},
+        {'name': 'users', 'version': 0}
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -1,29 +1,360 @@
+import math
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from sqlalchemy import Float, DateTime, ForeignKey
-from flask_sqlalchemy import SQLAlchemy
-import json
+from sqlalchemy import Column, String, Integer, event
+from sqlalchemy import Float, DateTime, ForeignKey, Index, func, or_, select
+from sqlalchemy.orm import configure_mappers, sessionmaker, validates
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.expression import Select, UpdateBase
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, _EngineConnector
+from itsdangerous import BadSignature, TimestampSigner
+from contextlib import contextmanager
+from itertools import chain
 from datetime import datetime
 
 database_path = os.environ['DATABASE_URL']
+# read replica of the database, read only requests are sent to it if set
+replica_path = os.environ.get('DATABASE_REPLICA_URL')
+
+# connection settings, read from the app config or else the environment
+DB_SETTINGS = {
+    # connections kept open in the pool of each worker
+    'DB_POOL_SIZE': 5,
+    # connections opened beyond the pool size under load
+    'DB_MAX_OVERFLOW': 10,
+    # seconds to wait for a free connection before giving up
+    'DB_POOL_TIMEOUT': 30,
+    # seconds after which a pooled connection is replaced
+    'DB_POOL_RECYCLE': 1800,
+    # test pooled connections before use, so dead ones are replaced
+    'DB_POOL_PRE_PING': True,
+    # milliseconds a statement may run before it is cancelled, 0 for none
+    'DB_STATEMENT_TIMEOUT': 0,
+    # connect through PgBouncer in transaction pooling mode
+    'DB_PGBOUNCER': False,
+    # seconds the read replica may lag behind the primary; a client which
+    # has written reads from the primary for this long afterwards
+    'DB_REPLICA_LAG': 2.0,
+}
+# cookie which tells that a client has written, signed with SECRET_KEY;
+# every server process can verify it, so a writer which sends cookies
+# reads from the primary whichever process answers. Clients which do
+# not are known by the write marks of the app, see cache.WriteMarks
+WRITE_MARKER_COOKIE = 'closet_wrote'
+
+
+class RoutingSession(SignallingSession):
+    """Session which sends the queries of read only work to the read
+    replica if one is configured. Writes, and the reads which have to
+    see them, go to the primary: reads of a session which has written,
+    and reads of a client which has written within DB_REPLICA_LAG, as
+    told by the write marks of the app or its write marker cookie.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+        event.listen(self, 'after_commit', self.record_write)
+        event.listen(self, 'after_rollback', self.forget_write)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        elif self.info.get('read_only') and isinstance(clause, Select) \
+                and self.can_read_replica():
+            return self.db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+    def can_read_replica(self):
+        """Returns: True if reads may be answered by the read replica"""
+        binds = self.app.config.get('SQLALCHEMY_BINDS') or {}
+        if 'replica' not in binds or self.info.get('wrote'):
+            return False
+        client = self.info.get('client')
+        return client is None or not wrote_recently(self.app, client)
+
+    @staticmethod
+    def record_write(session):
+        if session.info.pop('wrote', False):
+            # left for mark_writes()
+            session.info['committed_write'] = True
+
+    @staticmethod
+    def forget_write(session):
+        session.info.pop('wrote', None)
+
+
+class EngineConnector(_EngineConnector):
+    """Engine connector which creates the engines of binds with their
+    own options from SQLALCHEMY_BIND_ENGINE_OPTIONS, instead of those of
+    the primary database."""
+
+    def get_options(self, sa_url, echo):
+        if self._bind is None:
+            return super().get_options(sa_url, echo)
+        options = {}
+        self._sa.apply_pool_defaults(self._app, options)
+        self._sa.apply_driver_hacks(self._app, sa_url, options)
+        if echo:
+            options['echo'] = echo
+        bind_options = self._app.config.get(
+            'SQLALCHEMY_BIND_ENGINE_OPTIONS') or {}
+        options.update(bind_options.get(self._bind, {}))
+        options.update(self._sa._engine_options)
+        return options
+
+
+class Database(SQLAlchemy):
+    """SQLAlchemy service which routes read only work to a read replica,
+    and applies the statement timeout per transaction when connections
+    go through PgBouncer."""
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def make_connector(self, app=None, bind=None):
+        return EngineConnector(self, self.get_app(app), bind)
+
+    def create_engine(self, sa_url, engine_opts):
+        statement_timeout = engine_opts.pop('transaction_statement_timeout', 0)
+        engine = super().create_engine(sa_url, engine_opts)
+        if statement_timeout:
+            @event.listens_for(engine, 'begin')
+            def set_statement_timeout(conn):
+                conn.execute(
+                    'SET LOCAL statement_timeout = {:d}'.format(
+                        statement_timeout))
+        return engine
+
+
+db = Database()
+
+
+def get_db_setting(app, name, bind=None):
+    """Returns: connection setting from the app config or the environment,
+                converted to the type of its default value. Settings of a
+                bind like 'replica' are read from DB_REPLICA_POOL_SIZE and
+                so on, and default to those of the primary.
+    """
+    default = DB_SETTINGS[name]
+    value = None
+    if bind is not None:
+        bind_name = 'DB_{}_{}'.format(bind.upper(), name[len('DB_'):])
+        value = app.config.get(bind_name, os.environ.get(bind_name))
+    if value is None:
+        value = app.config.get(name, os.environ.get(name))
+    if value is None:
+        return default
+    if isinstance(default, bool) and not isinstance(value, bool):
+        # strings from the environment, or numbers like 1 from the config
+        return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+    return type(default)(value)
+
+
+def get_engine_options(app, database_path, bind=None):
+    """Returns: SQLAlchemy engine options for the connection pool of the
+                primary database, or of the given bind
+    """
+    if not database_path.startswith('postgres'):
+        return {}
+
+    statement_timeout = get_db_setting(app, 'DB_STATEMENT_TIMEOUT', bind)
+    if get_db_setting(app, 'DB_PGBOUNCER', bind):
+        # PgBouncer pools the server connections itself, and it neither
+        # passes startup options on nor keeps session settings, so the
+        # timeout is set at the start of every transaction.
+        # psycopg2 never uses server-side prepared statements.
+        return {
+            'poolclass': NullPool,
+            'transaction_statement_timeout': statement_timeout
+        }
 
-db = SQLAlchemy()
+    options = {
+        'pool_size': get_db_setting(app, 'DB_POOL_SIZE', bind),
+        'max_overflow': get_db_setting(app, 'DB_MAX_OVERFLOW', bind),
+        'pool_timeout': get_db_setting(app, 'DB_POOL_TIMEOUT', bind),
+        'pool_recycle': get_db_setting(app, 'DB_POOL_RECYCLE', bind),
+        'pool_pre_ping': get_db_setting(app, 'DB_POOL_PRE_PING', bind)
+    }
+    if statement_timeout:
+        options['connect_args'] = {
+            'options': '-c statement_timeout={:d}'.format(statement_timeout)
+        }
+    return options
 
 
-def setup_db(app, database_path=database_path):
-    """binds a flask application and a SQLAlchemy service"""
+def setup_db(app, database_path=database_path, replica_path=replica_path):
+    """binds a flask application and a SQLAlchemy service.
+    Read only work is sent to the replica if its path is given.
+
+    Note: RuntimeError will be raised if a replica is given without a
+          SECRET_KEY to sign write markers with.
+    """
+    app.secret_key = app.secret_key or os.environ.get('SECRET_KEY')
+    if replica_path and not app.secret_key:
+        raise RuntimeError('SECRET_KEY is needed to use a read replica')
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_BINDS"] = \
+        {'replica': replica_path} if replica_path else None
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options(
+        app, database_path)
+    app.config["SQLALCHEMY_BIND_ENGINE_OPTIONS"] = {
+        'replica': get_engine_options(app, replica_path, 'replica')
+    } if replica_path else {}
     db.app = app
     db.init_app(app)
 
 
+def write_signer(app):
+    return TimestampSigner(app.secret_key, salt='write-marker')
+
+
+def wrote_recently(app, client):
+    """Returns: True if the client has written within DB_REPLICA_LAG, as
+                told by the write marks of the app, or by a write marker
+                the request carries
+    """
+    lag = get_db_setting(app, 'DB_REPLICA_LAG')
+    write_marks = app.extensions.get('write_marks')
+    if write_marks is not None and write_marks.wrote_within(client, lag):
+        return True
+    if not has_request_context():
+        return False
+    marker = request.cookies.get(WRITE_MARKER_COOKIE)
+    if marker is None:
+        return False
+    try:
+        signed_client = write_signer(app).unsign(marker, max_age=lag)
+    except BadSignature:
+        # forged, or older than the lag
+        return False
+    return signed_client.decode('utf-8') == client
+
+
+def mark_writes(response):
+    """after_request hook: record in the write marks of the app that a
+    client's writes have been committed, and hand it a write marker, if
+    reads may go to a read replica."""
+    info = db.session.info
+    client = info.get('client')
+    if info.pop('committed_write', False) and client is not None \
+            and current_app.config.get('SQLALCHEMY_BINDS'):
+        lag = get_db_setting(current_app, 'DB_REPLICA_LAG')
+        write_marks = current_app.extensions.get('write_marks')
+        if write_marks is not None:
+            write_marks.mark(client, lag)
+        response.set_cookie(
+            WRITE_MARKER_COOKIE,
+            write_signer(current_app).sign(client).decode('utf-8'),
+            max_age=math.ceil(lag) + 1,
+            httponly=True,
+            samesite='Lax')
+    return response
+
+
+@contextmanager
+def unit_of_work():
+    """Run the enclosed database work as a single transaction.
+    Inside it, insert(), update() and delete() of the models only flush
+    their changes, which are committed once when the block exits, or
+    rolled back if it raises. Nested units join the outermost one.
+    Requests are units of work of their own, see start_unit_of_work().
+    """
+    info = db.session.info
+    depth = info.get('unit_of_work', 0)
+    info['unit_of_work'] = depth + 1
+    try:
+        yield
+        if depth == 0:
+            db.session.commit()
+    except BaseException:
+        if depth == 0:
+            db.session.rollback()
+        raise
+    finally:
+        info['unit_of_work'] = depth
+
+
+def start_unit_of_work():
+    """before_request hook: run the database work of the request as a
+    single unit of work, so the model helpers only flush their changes.
+    """
+    db.session.info['unit_of_work'] = 1
+
+
+def finish_unit_of_work(response):
+    """after_request hook: commit the work of a successful request, and
+    roll back that of a request which has been aborted.
+    """
+    info = db.session.info
+    if info.get('unit_of_work'):
+        if response.status_code < 400:
+            db.session.commit()
+        else:
+            db.session.rollback()
+        info['unit_of_work'] = 0
+    return response
+
+
+def end_unit_of_work(exc):
+    """teardown_request hook: roll back the work of a request which has
+    raised before it could be committed.
+    """
+    if db.session.info.pop('unit_of_work', 0):
+        db.session.rollback()
+
+
+@contextmanager
+def read_only():
+    """Send the queries of the enclosed work to the read replica.
+    Can be used as a decorator of read only request handlers as well.
+    Queries still go to the primary once the session has written.
+    """
+    info = db.session.info
+    previous = info.get('read_only', False)
+    info['read_only'] = True
+    try:
+        yield
+    finally:
+        info['read_only'] = previous
+
+
+def commit():
+    """commit the session, or only flush it inside a unit of work"""
+    if db.session.info.get('unit_of_work'):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+def next_ids(table, count):
+    """draw ids for new rows of the table from its PostgreSQL sequence,
+    so that rows inserted together are known by their id beforehand.
+
+    Returns: list of count ids
+    """
+    sequence = func.pg_get_serial_sequence(table.name, table.c.id.name)
+    result = db.session.execute(
+        select([func.nextval(sequence)])
+        .select_from(func.generate_series(1, count)))
+    return [row[0] for row in result]
+
+
 # --------------------------------------------- #
 # Clothes
 # Have type, size, and registered time
 # --------------------------------------------- #
 class Clothes(db.Model):
     __tablename__ = 'clothes'
+    __table_args__ = (
+        Index('ix_clothes_type_size', 'type', 'size'),
+        Index(
+            'ix_clothes_status_registered_time',
+            'status',
+            'registered_time'
+            ),
+    )
 
     id = Column(Integer, primary_key=True)
     type = Column(String(120), nullable=False)
@@ -42,24 +373,81 @@ class Clothes(db.Model):
         self.size = size
         self.status = status
 
+    @validates('size')
+    def validate_size(self, key, size):
+        """Returns: size as the float it is stored as, so that changes
+                    are formatted alike before and after the commit
+
+        Note: ValueError will be raised if size is not a finite number.
+        """
+        size = float(size)
+        if not math.isfinite(size):
+            raise ValueError('size is not finite')
+        return size
+
+    @classmethod
+    def available(cls):
+        """SQL condition matching clothes which have not been reserved"""
+        return or_(cls.status != 'reserved', cls.status.is_(None))
+
+    @classmethod
+    def claim(cls, clothes_id):
+        """mark the clothes as reserved unless it has been reserved.
+        Check and update are a single conditional UPDATE, so concurrent
+        claims on the same clothes cannot both succeed. The change is
+        committed together with the reservation.
+
+        Returns: True if the clothes has been claimed
+        """
+        claimed = cls.query.filter(cls.id == clothes_id, cls.available())\
+            .update({'status': 'reserved'}, synchronize_session=False)
+        if claimed == 1:
+            touch(cls.__tablename__)
+        return claimed == 1
+
+    @classmethod
+    def insert_many(cls, rows, chunk_size=1000):
+        """insert rows of clothes data in chunks with a single commit.
+        Each row gets its registered time just like insert() does.
+        PostgreSQL inserts a chunk with one multi-row INSERT of rows
+        whose ids have been drawn beforehand; other databases insert row
+        by row.
+
+        Returns: list of ids of the inserted rows, in the same order
+        """
+        table = cls.__table__
+        postgresql = db.session.get_bind().dialect.name == 'postgresql'
+        ids = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            for row in chunk:
+                row['registered_time'] = datetime.utcnow()
+            if postgresql:
+                # the order of RETURNING is not that of the rows
+                for row, clothes_id in zip(chunk, next_ids(table, len(chunk))):
+                    row['id'] = clothes_id
+                db.session.execute(table.insert().values(chunk))
+                ids.extend(row['id'] for row in chunk)
+            else:
+                for row in chunk:
+                    result = db.session.execute(table.insert(), row)
+                    ids.extend(result.inserted_primary_key)
+        touch(cls.__tablename__)
+        commit()
+        return ids
+
     def insert(self):
         self.registered_time = datetime.utcnow()
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def update(self):
         self.registered_time = datetime.utcnow()
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
-
-    def rollback(self):
-        db.session.rollback()
-
-    def close_session(self):
-        db.session.close()
+        commit()
 
     def format(self):
         return {
@@ -98,20 +486,14 @@ class User(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
-
-    def rollback(self):
-        db.session.rollback()
-
-    def close_session(self):
-        db.session.close()
+        commit()
 
     def format(self):
         return {
@@ -137,21 +519,147 @@ class Reserve(db.Model):
         nullable=False,
         unique=True
         )
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user_id = Column(
+        Integer,
+        ForeignKey('users.id'),
+        nullable=False,
+        index=True
+        )
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
+
+    @staticmethod
+    def insert_all(rows):
+        """insert several reservations with a single statement and commit.
+        rows: list of dicts of clothes_id and user_id
+        """
+        if rows:
+            db.session.execute(Reserve.__table__.insert(), rows)
+        commit()
+
+    @staticmethod
+    def cancel_all(user_id):
+        """cancel all reservations of the given user in a single commit.
+        Reservations are removed by one DELETE, which returns their
+        clothes ids on PostgreSQL, and those clothes are released by one
+        UPDATE.
+
+        Returns: list of formatted clothes of which reservations have
+                 been cancelled, in order of id
+        """
+        reserves = Reserve.__table__
+        delete = reserves.delete().where(reserves.c.user_id == user_id)
+        if db.session.get_bind().dialect.name == 'postgresql':
+            result = db.session.execute(
+                delete.returning(reserves.c.clothes_id))
+            clothes_ids = [row.clothes_id for row in result]
+        else:
+            clothes_ids = [row.clothes_id for row in db.session.query(
+                Reserve.clothes_id).filter_by(user_id=user_id)]
+            db.session.execute(
+                delete.where(reserves.c.clothes_id.in_(clothes_ids)))
+
+        formatted_clothes = []
+        if clothes_ids:
+            Clothes.query.filter(Clothes.id.in_(clothes_ids))\
+                .update({'status': ''}, synchronize_session=False)
+            touch(Clothes.__tablename__)
+            clothes = Clothes.query.filter(Clothes.id.in_(clothes_ids))\
+                .order_by(Clothes.id).all()
+            formatted_clothes = [item.format() for item in clothes]
+        commit()
+        return formatted_clothes
 
     def update(self):
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
+
+
+# --------------------------------------------- #
+# Table versions
+# Counters of committed changes, for validating cached responses
+# --------------------------------------------- #
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    # tables of which changes are counted
+    TABLES = ('clothes', 'users')
+
+    name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def get(cls, name):
+        """Returns: number of committed transactions which have changed
+                    the table
+        """
+        version = db.session.query(cls.version)\
+            .filter(cls.name == name).scalar()
+        return version or 0
+
+
+@event.listens_for(TableVersion.__table__, 'after_create')
+def add_table_versions(target, connection, **kw):
+    connection.execute(
+        target.insert(),
+        [{'name': name, 'version': 0} for name in TableVersion.TABLES])
+
+
+def touch(*tables):
+    """count a change of the tables made by a bulk statement, which the
+    session cannot see, when the transaction is committed"""
+    db.session.info.setdefault('touched', set()).update(tables)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def touch_flushed_tables(session, flush_context, instances):
+    touched = session.info.setdefault('touched', set())
+    for obj in chain(session.new, session.dirty, session.deleted):
+        touched.add(obj.__table__.name)
+
+
+@event.listens_for(RoutingSession, 'before_commit')
+def bump_table_versions(session):
+    """count a change of each touched table in the transaction which
+    makes it, so the versions change exactly when the data does. The
+    count is the last statement before the commit, so writers hold the
+    version rows only for the commit itself.
+    """
+    # flush the last changes first, so their tables are touched too
+    session.flush()
+    touched = session.info.pop('touched', set())
+    names = touched.intersection(TableVersion.TABLES)
+    if not names:
+        return
+    versions = TableVersion.__table__
+    session.execute(
+        versions.update()
+        .where(versions.c.name.in_(sorted(names)))
+        .values(version=versions.c.version + 1))
+    # left for the listeners of after_commit
+    session.info['bumped_tables'] = names
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_touched_tables(session):
+    session.info.pop('touched', None)
+    session.info.pop('bumped_tables', None)
+
+
+# available clothes in order of id, for browsing what can be reserved
+Index(
+    'ix_clothes_available',
+    Clothes.id,
+    postgresql_where=Clothes.available(),
+    sqlite_where=Clothes.available()
+    )
 
-    def rollback(self):
-        db.session.rollback()
 
-    def close_session(self):
-        db.session.close()
+# set up the backrefs Reserve.clothes and Reserve.user now, so that they
+# can be used in queries and joins before the first query
+configure_mappers()
@@ -0,0 +1,199 @@
+import json
+import os
+import re
+from datetime import datetime
+from flask import Response, current_app, jsonify
+from sqlalchemy import Float
+from models import Clothes, User
+from metrics import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# encoder of list responses, 'orjson' if it is installed or else 'json'
+JSON_ENCODER = os.environ.get(
+    'JSON_ENCODER', 'json' if orjson is None else 'orjson')
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def http_date(value):
+    """Returns: datetime formatted as an HTTP date, just like Flask's JSON
+                encoder formats it; naive datetimes are taken as UTC
+    """
+    if value is None:
+        return None
+    t = value.utctimetuple()
+    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        WEEKDAYS[t.tm_wday], t.tm_mday, MONTHS[t.tm_mon - 1],
+        t.tm_year, t.tm_hour, t.tm_min, t.tm_sec)
+
+
+def encode_default(obj):
+    """encode the values the encoders do not know, like Flask does"""
+    if isinstance(obj, datetime):
+        return http_date(obj)
+    raise TypeError(
+        'Object of type {} is not JSON serializable'.format(
+            type(obj).__name__))
+
+
+def dumps_json(obj):
+    """Returns: obj encoded by the standard library, as bytes"""
+    return json.dumps(
+        obj,
+        sort_keys=True,
+        separators=(',', ':'),
+        default=encode_default
+        ).encode('ascii')
+
+
+# characters orjson writes as they are, and the standard library escapes
+NOT_ASCII = re.compile('[\x7f-\U0010ffff]')
+
+
+def escape_not_ascii(match):
+    """Returns: character escaped the way the standard library does"""
+    code = ord(match.group(0))
+    if code < 0x10000:
+        return '\\u{:04x}'.format(code)
+    code -= 0x10000
+    return '\\u{:04x}\\u{:04x}'.format(
+        0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+
+
+def float_differs(value):
+    """Returns: True if value is a float orjson writes unlike the standard
+                library: NaN and infinities, which orjson writes as null,
+                and those written with an exponent, like 1e16 for 1e+16
+    """
+    return type(value) is float and \
+        not (1e-4 <= abs(value) < 1e16 or value == 0.0)
+
+
+def floats_differ(obj):
+    """Returns: True if obj holds a float for which float_differs()"""
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, Rows):
+            # checked when they were formatted
+            if value.floats_differ:
+                return True
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+        elif float_differs(value):
+            return True
+    return False
+
+
+def dumps_orjson(obj):
+    """Returns: obj encoded by orjson, as bytes
+
+    Note: Text which orjson leaves as it is gets escaped, and payloads
+          with numbers orjson would write differently are encoded by
+          the standard library, so that the output stays the same.
+    """
+    if floats_differ(obj):
+        return dumps_json(obj)
+    try:
+        data = orjson.dumps(
+            obj,
+            default=encode_default,
+            option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+    except TypeError:
+        return dumps_json(obj)
+    if data.isascii() and b'\x7f' not in data:
+        return data
+    # such characters only occur inside strings
+    return NOT_ASCII.sub(
+        escape_not_ascii, data.decode('utf-8')).encode('ascii')
+
+
+ENCODERS = {'json': dumps_json}
+if orjson is not None:
+    ENCODERS['orjson'] = dumps_orjson
+
+
+def dumps(obj, encoder=None):
+    """Encode plain data the same way jsonify does with the default
+    JSON_SORT_KEYS and JSON_AS_ASCII, but without the trailing newline.
+    The encoder falls back to 'json' if orjson is not installed.
+
+    Returns: json bytes
+    """
+    return ENCODERS.get(encoder or JSON_ENCODER, dumps_json)(obj)
+
+
+def json_response(obj):
+    """Returns: response with the same body and mimetype as jsonify(obj)"""
+    if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or \
+            current_app.debug:
+        # indented for people reading it, as jsonify does
+        return jsonify(obj)
+    with timed('serialize'):
+        data = dumps(obj) + b'\n'
+    return Response(data, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+class Rows(list):
+    """Rows formatted by a Serializer, which tell whether they hold floats
+    for which float_differs(), so that they are not searched again."""
+    floats_differ = False
+
+
+class Serializer:
+    """Formats rows of selected columns the same way format() of a model
+    formats its instances, without loading the instances.
+
+    fields: sequence of (key, column) or (key, column, convert)
+    """
+
+    def __init__(self, fields):
+        self.keys = tuple(field[0] for field in fields)
+        self.columns = tuple(field[1] for field in fields)
+        self.converters = tuple(
+            (field[0], field[2]) for field in fields if len(field) == 3)
+        self.float_keys = tuple(
+            field[0] for field in fields
+            if len(field) == 2 and isinstance(field[1].type, Float))
+
+    def project(self, query):
+        """Returns: query selecting only the columns of the fields"""
+        return query.with_entities(*self.columns)
+
+    def format(self, row):
+        formatted = dict(zip(self.keys, row))
+        for key, convert in self.converters:
+            formatted[key] = convert(formatted[key])
+        return formatted
+
+    def format_all(self, rows):
+        formatted = Rows(self.format(row) for row in rows)
+        formatted.floats_differ = any(
+            float_differs(row[key])
+            for key in self.float_keys for row in formatted)
+        return formatted
+
+
+clothes_serializer = Serializer([
+    ('id', Clothes.id),
+    ('type', Clothes.type),
+    ('size', Clothes.size),
+    ('registerd', Clothes.registered_time, http_date),
+    ('status', Clothes.status)
+])
+
+user_serializer = Serializer([
+    ('id', User.id),
+    ('auth0_id', User.auth0_id),
+    ('role', User.role),
+    ('e_mail', User.e_mail),
+    ('address', User.address)
+])